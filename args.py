@@ -59,6 +59,9 @@ def add_args():
     parser.add_argument('--train_accuracy', action='store_true',
                         default=argparse.SUPPRESS)
     parser.add_argument('--log_profiler', action='store_true')
+    parser.add_argument('--snap_trace', action='store_true',
+                        help='dump the stage times of every snapshot as a '
+                        'chrome trace')
     parser.add_argument('--lr_decay_epoch',
                         default=argparse.SUPPRESS)
     parser.add_argument('--log_keys', default='')
@@ -89,6 +92,11 @@ def add_args():
                         default=argparse.SUPPRESS, type=int)
     parser.add_argument('--gvar_start',
                         default=argparse.SUPPRESS, type=int)
+    parser.add_argument('--gvar_two_pass', action='store_true',
+                        help='estimate the gradient variance from samples '
+                        'independent of the mean (twice the samples, '
+                        'biased up by (gviter + 1) / gviter as in older '
+                        'logs)')
     parser.add_argument('--g_optim',
                         default=argparse.SUPPRESS, action='store_true')
     parser.add_argument('--g_optim_start',
@@ -103,6 +111,9 @@ def add_args():
                         default=argparse.SUPPRESS, type=int)
     parser.add_argument('--no_batch_norm',
                         default=argparse.SUPPRESS, type=bool)
+    parser.add_argument('--flat_buffer', action='store_true',
+                        help='keep the parameters and gradients in one '
+                        'contiguous buffer and step the optimizer on it')
     # NUQ
     parser.add_argument('--nuq_method', default='q', help='q|nuq|qinf')
     parser.add_argument('--nuq_bits', default=4, type=int)
@@ -113,6 +124,8 @@ def add_args():
                         default=0.7, type=float)
     parser.add_argument('--nuq_amq_epochs',
                         default=50, type=int)
+    parser.add_argument('--nuq_amq_solver', default='secant',
+                        help='secant|gd')
     parser.add_argument('--untrain_steps', default=0, type=int)
     parser.add_argument('--untrain_lr', default=0.001, type=float)
     parser.add_argument('--untrain_std', default=0.001, type=float)
@@ -120,6 +133,10 @@ def add_args():
     parser.add_argument('--nuq_inv', default=False, action='store_true')
     parser.add_argument('--nuq_parallel', default='no', help='no|gpu1|ngpu')
     parser.add_argument('--dist_num', default=20, type=int)
+    parser.add_argument('--nuq_dist_reduce', default='topk',
+                        help='reduction of the bucket statistics to dist_num '
+                        'components: topk (largest norms)|kmeans (merge '
+                        'clusters of all buckets)')
     parser.add_argument('--chkpt_iter', default=20, type=int)
     parser.add_argument('--nuq_number_of_samples',
                         default=argparse.SUPPRESS,
@@ -136,6 +153,65 @@ def add_args():
                         help='NUQ Adaptive CD Epochs', type=int)
     parser.add_argument('--nuq_layer', action='store_true',
                         help='NUQ Enable Network Wide Quantization')
+    parser.add_argument('--nuq_dp_bins', default=1000, type=int,
+                        help='NUQ grid size of the dynamic programming '
+                        'level solver (alqdp)')
+    parser.add_argument('--nuq_adam_lr', default=1e-3, type=float,
+                        help='NUQ learning rate of the joint level '
+                        'optimizer (alqt)')
+    parser.add_argument('--nuq_adam_epochs', default=500, type=int,
+                        help='NUQ number of steps of the joint level '
+                        'optimizer (alqt)')
+    parser.add_argument('--nuq_level_groups', default='',
+                        help='NUQ separate levels per layer group with '
+                        'layer-wise quantization, solved in one batch by '
+                        'the joint level optimizer (alqt, alqt_nb), not '
+                        'with --nuq_layer: |layer|ndim')
+    parser.add_argument('--nuq_vmap_grads', action='store_true',
+                        help='NUQ compute the gradients of all the samples '
+                        'of a snapshot in one batched pass with torch.func '
+                        '(falls back to one at a time with batch norm in '
+                        'train mode or torch < 2.0)')
+    parser.add_argument('--nuq_bucket_sample', default=0, type=int,
+                        help='NUQ number of buckets sampled for the '
+                        'statistics of a snapshot (0 uses all the buckets)')
+    parser.add_argument('--nuq_bucket_sample_type', default='uniform',
+                        help='NUQ sampling of the buckets: uniform|norm '
+                        '(equal number from every norm quartile)')
+    parser.add_argument('--nuq_dist', default='normal',
+                        help='NUQ distribution of the normalized gradient: '
+                        'normal (mixture of truncated normals fitted to '
+                        'the buckets)|hist (histogram counted on the '
+                        'device)|sketch (streaming quantile sketch)')
+    parser.add_argument('--nuq_dist_backend', default='numpy',
+                        help='NUQ implementation of the distributions: '
+                        'numpy|torch (on the device of the gradients, '
+                        'normal distribution and alqt methods only)')
+    parser.add_argument('--nuq_hist_bins', default=8192, type=int,
+                        help='NUQ number of bins of the hist distribution')
+    parser.add_argument('--nuq_ema_weight', default=1., type=float,
+                        help='NUQ weight of a new snapshot in the moving '
+                        'average of the distributions (1 disables it)')
+    parser.add_argument('--nuq_sketch_size', default=2048, type=int,
+                        help='NUQ capacity of every level of the sketch '
+                        'distribution')
+    parser.add_argument('--nuq_bin_type', default='linear',
+                        help='NUQ bins of the distribution tables: linear|'
+                        'quantile (dense where the mass is)')
+    parser.add_argument('--nuq_nbins', default=50000, type=int,
+                        help='NUQ number of bin edges of the distribution '
+                        'tables')
+    parser.add_argument('--nuq_quad_order', default=32, type=int,
+                        help='NUQ order of the Gauss-Legendre quadrature '
+                        'of the distribution integrals')
+    parser.add_argument('--nuq_error_int', action='store_true',
+                        help='NUQ log the error of the levels integrated '
+                        'from the pdf instead of the moment tables')
+    parser.add_argument('--nuq_cache_size', default=0, type=int,
+                        help='NUQ number of cached level solutions '
+                        '(0 disables the cache)')
+    parser.add_argument('--nuq_cache_tol', default=1e-3, type=float,
+                        help='NUQ tolerance of the level cache signature')
     args = parser.parse_args()
     return args
 
@@ -149,7 +225,15 @@ def opt_to_nuq_kwargs(opt):
         'path': opt.logger_name, 'symmetric': opt.nuq_sym,
         'interval': opt.nuq_truncated_interval, 'amq_epochs': opt.nuq_amq_epochs,
         'learning_rate': opt.nuq_learning_rate, 'amq_lr': opt.nuq_amq_lr,
-        'ig_sm_bkts': opt.nuq_ig_sm_bkts, 'inv': opt.nuq_inv
+        'ig_sm_bkts': opt.nuq_ig_sm_bkts, 'inv': opt.nuq_inv,
+        'cache_size': opt.nuq_cache_size, 'cache_tol': opt.nuq_cache_tol,
+        'dp_bins': opt.nuq_dp_bins, 'adam_lr': opt.nuq_adam_lr,
+        'adam_epochs': opt.nuq_adam_epochs, 'amq_solver': opt.nuq_amq_solver,
+        'dist': opt.nuq_dist, 'quad_order': opt.nuq_quad_order,
+        'nbins': opt.nuq_nbins, 'bin_type': opt.nuq_bin_type,
+        'ema_weight': opt.nuq_ema_weight, 'dist_backend': opt.nuq_dist_backend,
+        'error_int': opt.nuq_error_int, 'level_groups': opt.nuq_level_groups,
+        'network_wide': opt.nuq_layer
     }
 
 
@@ -1,15 +1,112 @@
 from scipy.stats import truncnorm
-from scipy import integrate
+from scipy import integrate, special
+from collections import Counter
+import functools
 import numpy as np
-import bisect
+import torch
+
+# Number of pdf/cdf/ppf evaluations and numerical integrations, read and
+# reset by the snapshot timing logs
+call_counts = Counter()
+
+
+def counted(name):
+    def decorator(f):
+        @functools.wraps(f)
+        def wrapper(*args, **kwargs):
+            call_counts[name] += 1
+            return f(*args, **kwargs)
+        return wrapper
+    return decorator
+
+
+def _quad(f, a, b):
+    call_counts['quad'] += 1
+    return integrate.quad(f, a, b)
+
+
+@functools.lru_cache(maxsize=None)
+def _gauss_legendre(order):
+    """Nodes and weights of Gauss-Legendre quadrature on [-1, 1]"""
+    return np.polynomial.legendre.leggauss(order)
+
+
+def _normal_interval_mass(za, zb):
+    """Standard normal mass of [za, zb] (za <= zb) computed from tail
+    masses so that it stays accurate far from the mean.
+    """
+    ta = special.ndtr(-np.abs(za))
+    tb = special.ndtr(-np.abs(zb))
+    return np.where(za >= 0, ta - tb,
+                    np.where(zb <= 0, tb - ta, 1 - ta - tb))
+
+
+def _normal_pdf(z):
+    return np.exp(-z ** 2 / 2) / np.sqrt(2 * np.pi)
+
+
+def reduce_mixture(means, sigmas, norms, num_components, iters=20):
+    """Cluster the (mean, sigma) summaries of the buckets with weighted
+    k-means and merge every cluster into one normal that matches its first
+    two moments. The weight of a merged component is the sum of the norms.
+
+    Parameters:
+        means (np.ndarray): means of the buckets
+        sigmas (np.ndarray): standard deviations of the buckets
+        norms (np.ndarray): norms of the buckets (mixture weights)
+        num_components (int): number of components of the reduced mixture
+        iters (int): number of k-means iterations
+    """
+    means = np.asarray(means, dtype=np.float64)
+    sigmas = np.asarray(sigmas, dtype=np.float64)
+    norms = np.asarray(norms, dtype=np.float64)
+    # all-zero buckets have no mean and sigma and no weight
+    valid = np.isfinite(means) & np.isfinite(sigmas) & (norms > 0)
+    means, sigmas, norms = means[valid], sigmas[valid], norms[valid]
+    points = np.stack((means, sigmas), axis=1)
+    # start from the largest buckets, i.e. the top-k reduction
+    centers = points[np.argsort(-norms)[:num_components]]
+    for _ in range(iters):
+        dists = ((points[:, np.newaxis, :] - centers) ** 2).sum(axis=2)
+        assign = dists.argmin(axis=1)
+        weight = np.bincount(assign, norms, minlength=len(centers))
+        sums = np.stack([np.bincount(assign, norms * points[:, i],
+                                     minlength=len(centers))
+                         for i in range(2)], axis=1)
+        # empty clusters keep their center
+        nonempty = weight > 0
+        new_centers = centers.copy()
+        new_centers[nonempty] = sums[nonempty] / weight[nonempty, np.newaxis]
+        if np.allclose(new_centers, centers):
+            break
+        centers = new_centers
+
+    weight = np.bincount(assign, norms, minlength=len(centers))
+    first = np.bincount(assign, norms * means, minlength=len(centers))
+    second = np.bincount(assign, norms * (sigmas ** 2 + means ** 2),
+                         minlength=len(centers))
+    nonempty = weight > 0
+    weight = weight[nonempty]
+    mean = first[nonempty] / weight
+    var = np.maximum(second[nonempty] / weight - mean ** 2, 0)
+    return mean, np.sqrt(var), weight
 
 
 class Distribution:
-
-    def __init__(self, begin=-1, end=+1, nbins=1000, bin_type='linear'):
+    # integrals of the density over intervals are computed with
+    # 'gauss': fixed-order Gauss-Legendre on all intervals at once,
+    # 'table': exactly on the moment tables (piecewise uniform densities),
+    # 'adaptive': scipy quad, one interval at a time
+    quadrature = 'gauss'
+    quad_order = 32
+
+    def __init__(self, begin=-1, end=+1, nbins=1000, bin_type='linear',
+                 bin_edges=None):
         self.begin = begin
         self.end = end
-        self.bin_edges = bin_edges = self._get_bin_edges(nbins, bin_type)
+        if bin_edges is None:
+            bin_edges = self._get_bin_edges(nbins, bin_type)
+        self.bin_edges = bin_edges = np.asarray(bin_edges, dtype=np.float64)
         self.bin_centers = (bin_edges[1:]+bin_edges[:-1])/2
         self.bin_width = (bin_edges[1:]-bin_edges[:-1])
 
@@ -19,84 +116,182 @@ class Distribution:
         elif bin_type == 'log':
             bin_edges = np.logspace(self.begin, self.end, nbins)/10
             bin_edges = np.concatenate((-np.flip(bin_edges), [0], bin_edges))
+        elif bin_type == 'quantile':
+            # dense bins where the mass is, coarse bins in the tails
+            bin_edges = self._quantile_bin_edges(nbins)
+        return bin_edges
+
+    def _quantile_bin_edges(self, nbins, pilot_bins=4096, uniform_weight=0.1):
+        """Quantiles of the density to the power 1/3 mixed with a uniform
+        density, found on a linear pilot grid. The 1/3 power minimizes the
+        error of the piecewise uniform approximation, the plain density
+        would leave the tails, where wide intervals weigh most, too coarse.
+
+        Parameters:
+            nbins (int): number of edges
+            pilot_bins (int): number of bins of the pilot grid
+            uniform_weight (float): weight of the uniform density that
+                                    bounds the width of the tail bins
+        """
+        pilot_edges = np.linspace(self.begin, self.end, pilot_bins + 1)
+        mass = np.maximum(np.diff(self._pilot_cdf(pilot_edges)), 0)
+        cdf = np.concatenate(([0.], np.cumsum(mass ** (1. / 3))))
+        cdf = ((1 - uniform_weight) * cdf / cdf[-1]
+               + uniform_weight * np.linspace(0, 1, pilot_bins + 1))
+        bin_edges = np.interp(np.linspace(0, 1, nbins), cdf, pilot_edges)
+        bin_edges[0] = self.begin
+        bin_edges[-1] = self.end
         return bin_edges
 
+    def _pilot_cdf(self, x):
+        """CDF available before the bins are built"""
+        return self.cdf(x)
+
+    def _integrate_poly(self, coeffs, left, right):
+        """int_left^right (p0 + p1 x + p2 x^2) pdf(x) dx for arrays of
+        intervals
+
+        Parameters:
+            coeffs (tuple): polynomial coefficients (p0, p1, p2)
+            left (np.ndarray): left ends of the intervals
+            right (np.ndarray): right ends of the intervals
+        """
+        p0, p1, p2, c, d = np.broadcast_arrays(
+            *[np.asarray(v, dtype=np.float64) for v in coeffs],
+            np.asarray(left, dtype=np.float64),
+            np.asarray(right, dtype=np.float64))
+        if self.quadrature == 'table':
+            m0, m1, m2 = self.partial_moments(np.stack((c, d)))
+            intg = (p0 * (m0[1] - m0[0]) + p1 * (m1[1] - m1[0])
+                    + p2 * (m2[1] - m2[0]))
+        elif self.quadrature == 'gauss':
+            nodes, weights = _gauss_legendre(self.quad_order)
+            half = ((d - c) / 2)[..., np.newaxis]
+            x = ((c + d) / 2)[..., np.newaxis] + half * nodes
+            poly = (p0[..., np.newaxis] + x * (
+                p1[..., np.newaxis] + x * p2[..., np.newaxis]))
+            intg = np.sum(weights * half * poly * self.pdf(x), axis=-1)
+        else:
+            intg = np.zeros(c.shape)
+            for index in np.ndindex(c.shape):
+                q0, q1, q2 = p0[index], p1[index], p2[index]
+                intg[index] = _quad(
+                    lambda x: (q0 + x * (q1 + x * q2)) * self.pdf(x),
+                    c[index], d[index])[0]
+        return intg[()]
+
     def est_var_pgd_adj_levels(self, left_level, current_level, right_level):
         # From below Eq 10 in the ICML submission
-        # int_c^d (x - c) f(r) dr
-        # = sum_{ind(e_l)}^{ind(e_r)} f(r)
-        #   int_{max(c,e_l)}^{min(e_r,d)} (x - c) f(r) dr
+        # int_c^e (x - c) f(r) dr + int_e^d (x - d) f(r) dr
 
-        c = left_level
-        d = right_level
+        c = np.asarray(left_level, dtype=np.float64)
+        d = np.asarray(right_level, dtype=np.float64)
         e = current_level
 
-        def f(x):
-            return (x - left_level) * self.pdf(x)
-
-        def g(x):
-            return (x - right_level) * self.pdf(x)
-
-        intg = integrate.quad(f, c, e)[0] + integrate.quad(g, e, d)[0]
-        return intg
+        return (self._integrate_poly((-c, 1, 0), c, e)
+                + self._integrate_poly((-d, 1, 0), e, d))
 
     def est_var_adjacent_levels(self, left_level, right_level):
         # From Eq 6 in the paper
-        # int_a^b sigma^2(r) f(r) dr
-        # = sum_{ind(e_l)}^{ind(e_r)} f(r)
-        #         int_{max(a,e_l)}^{min(e_r,b)} sigma^2(r) dr
+        # int_c^d (x - c) (d - x) f(r) dr
 
-        c = left_level
-        d = right_level
-
-        def f(x):
-            return (x - c) * (d - x) * self.pdf(x)
+        c = np.asarray(left_level, dtype=np.float64)
+        d = np.asarray(right_level, dtype=np.float64)
 
-        intg = integrate.quad(f, c, d)[0]
-
-        return intg
+        return self._integrate_poly((-c * d, c + d, -1), c, d)
 
     def estimate_variance_adj_inv(self, left_level, right_level):
         # calculate Eq 8 of the paper
         # ppf(cdf(d) - int_c^d (r - c) * pdf(r) dr / (d - c))
-        # integration is equal to
-        # = sum_{ind(e_l)}^{ind(e_r)} f(r)
-        #         int_{max(a,e_l)}^{min(e_r,b)} (r-c) dr
         # where c is left_level and d is right_level
-        c = left_level
-        d = right_level
+        c = np.asarray(left_level, dtype=np.float64)
+        d = np.asarray(right_level, dtype=np.float64)
 
-        def f(x):
-            return (x - c) * self.pdf(x)
-        intg_by_intg = integrate.quad(f, c, d)[0]
+        intg_by_intg = self._integrate_poly((-c, 1, 0), c, d)
 
         inv_arg = self.cdf(right_level) - intg_by_intg / (d-c)
         return self.ppf(inv_arg)
 
     def estimate_variance(self, levels):
-        var = 0
-        for index, left_level in enumerate(levels[:-1]):
-            right_level = levels[index+1]
-            var += self.est_var_adjacent_levels(
-                left_level, right_level)
-        return var
+        levels = np.asarray(levels, dtype=np.float64)
+        return np.sum(self.est_var_adjacent_levels(levels[:-1], levels[1:]))
 
-    def estimate_variance_int(self, levels, dist=None):
-        # variance estimate calculation by integration
-        # optional dist parameter to provide your own distribution function
+    def estimate_variance_batch(self, levels_matrix):
+        """Variance of every row of a (candidates x levels) array computed
+        in one pass.
+        """
+        levels = np.asarray(levels_matrix, dtype=np.float64)
+        return self.est_var_adjacent_levels(
+            levels[:, :-1], levels[:, 1:]).sum(axis=1)
 
-        var = 0.0
+    def estimate_variance_int(self, levels, dist=None):
+        """Variance of the levels by integrating the pdf directly, without
+        the closed forms and moment tables of estimate_variance, to
+        validate them. All intervals are integrated in one pass of
+        composite Gauss-Legendre quadrature.
+
+        Parameters:
+            levels (np.ndarray): sorted quantization levels
+            dist (Distribution): optional distribution to integrate
+        """
         dist = self if dist is None else dist
-
-        for index, _ in enumerate(levels[:-1]):
-            def f(x):
-                pdf = dist.pdf(x)
-                index_l = bisect.bisect_left(levels, x) - 1
-                variance = (x - levels[index_l]) * (levels[index_l + 1] - x)
-                return variance * pdf
-            var += integrate.quad(lambda x: f(x),
-                                  levels[index], levels[index + 1])[0]
-        return var
+        levels = np.asarray(levels, dtype=np.float64)
+        if dist.quadrature == 'table':
+            # the density is uniform in every bin, order 2 is exact
+            # between the bin edges
+            breaks = dist.bin_edges
+            order = 2
+        else:
+            breaks = levels
+            order = dist.quad_order
+        inside = (breaks > levels[0]) & (breaks < levels[-1])
+        breaks = np.unique(np.concatenate((levels, breaks[inside])))
+        nodes, weights = _gauss_legendre(order)
+        half = (np.diff(breaks) / 2)[:, np.newaxis]
+        x = ((breaks[:-1] + breaks[1:]) / 2)[:, np.newaxis] + half * nodes
+        # interval of the levels every node falls in
+        index = np.clip(np.searchsorted(levels, x, side='right') - 1,
+                        0, len(levels) - 2)
+        var = (x - levels[index]) * (levels[index + 1] - x) * dist.pdf(x)
+        return np.sum(weights * half * var)
+
+    def bin_mass(self):
+        """Probability mass of every bin."""
+        mass = np.diff(self.cdf(self.bin_edges))
+        return mass / mass.sum()
+
+    def moment_tables(self):
+        """Cumulative zeroth, first and second moments at the bin edges
+        assuming the density is uniform inside every bin.
+        """
+        if getattr(self, '_moment_tables', None) is None:
+            mass = self.bin_mass()
+            left = self.bin_edges[:-1]
+            right = self.bin_edges[1:]
+            moments = (mass,
+                       mass * (left + right) / 2,
+                       mass * (left ** 2 + left * right + right ** 2) / 3)
+            self._moment_tables = [
+                np.concatenate(([0.], np.cumsum(m))) for m in moments]
+        return self._moment_tables
+
+    def partial_moments(self, x):
+        """Zeroth, first and second moments of the density on [begin, x].
+
+        Parameters:
+            x (np.ndarray): points to evaluate the moments at
+        """
+        m0, m1, m2 = self.moment_tables()
+        bin_edges = self.bin_edges
+        x = np.clip(np.asarray(x, dtype=np.float64),
+                    bin_edges[0], bin_edges[-1])
+        index = np.clip(np.searchsorted(bin_edges, x, side='right') - 1,
+                        0, len(bin_edges) - 2)
+        left = bin_edges[index]
+        density = (m0[index + 1] - m0[index]) / self.bin_width[index]
+        return (m0[index] + density * (x - left),
+                m1[index] + density * (x ** 2 - left ** 2) / 2,
+                m2[index] + density * (x ** 3 - left ** 3) / 3)
 
     def pdf(self, x):
         raise NotImplementedError('PDF has not been implemented.')
@@ -105,40 +300,85 @@ class Distribution:
         raise NotImplementedError('CDF has not been implemented.')
 
 class HistDistribution(Distribution):
+    # the density is uniform inside every bin
+    quadrature = 'table'
 
-    def __init__(self, cdf_f, begin=-1, end=+1, nbins=1000, bin_type='linear'):
-        super().__init__(begin=begin, end=end, nbins=nbins, bin_type=bin_type)
+    def __init__(self, cdf_f, begin=-1, end=+1, nbins=1000, bin_type='linear',
+                 pdf_bin_sum=None, bin_edges=None):
+        super().__init__(begin=begin, end=end, nbins=nbins, bin_type=bin_type,
+                         bin_edges=bin_edges)
         self.cdf_f = cdf_f
-        self.pdf_bin_sum = self._quantized_sum_pdf()
+        if pdf_bin_sum is None:
+            self.pdf_bin_sum = self._quantized_sum_pdf()
+        else:
+            # precomputed table, e.g. from a checkpoint
+            pdf_bin_sum = np.asarray(pdf_bin_sum, dtype=np.float64)
+            self.pdf_bin_sum = pdf_bin_sum / pdf_bin_sum.sum()
+        self._set_tables()
+
+    def _set_tables(self):
         self.cdf_bin_sum = np.cumsum(self.pdf_bin_sum).clip(0, 1)
-
+        self.pdf_at_centers = self.pdf_bin_sum / self.bin_width
+        self._moment_tables = None
+
+    def blend(self, previous, weight):
+        """Replace the tables by weight * self + (1 - weight) * previous,
+        the previous distribution is rebinned on the bins of this one
+
+        Parameters:
+            previous (Distribution): distribution of an older snapshot
+            weight (float): weight of this distribution
+        """
+        previous_mass = np.diff(previous.cdf(self.bin_edges))
+        previous_mass /= previous_mass.sum()
+        self.pdf_bin_sum = (weight * self.pdf_bin_sum
+                            + (1 - weight) * previous_mass)
+        self._set_tables()
+
+    # pdf, cdf and ppf accept scalars or arrays, values outside
+    # [begin, end] have zero density
+
+    @counted('cdf')
     def cdf(self, x):
-        index = bisect.bisect_right(self.bin_edges, x)-1
-        if index == len(self.bin_edges)-1:
-            # case: x=self.end
-            return 1.0
-        cdf_at_x = self.cdf_bin_sum[index-1] if index > 0 else 0
-        weight = (x-self.bin_edges[index])/self.bin_width[index]
-        cdf_at_x += weight*self.pdf_bin_sum[index]
-        return cdf_at_x
-
+        x = np.asarray(x, dtype=float)
+        index = np.searchsorted(self.bin_edges, x, side='right')-1
+        last = len(self.bin_edges)-1
+        bin_index = index.clip(0, last-1)
+        cdf_at_x = np.where(
+            bin_index > 0, self.cdf_bin_sum[bin_index-1], 0.0)
+        weight = (x-self.bin_edges[bin_index])/self.bin_width[bin_index]
+        cdf_at_x = cdf_at_x + weight*self.pdf_bin_sum[bin_index]
+        # case: x=self.end
+        cdf_at_x = np.where(index >= last, 1.0, cdf_at_x)
+        return np.where(index < 0, 0.0, cdf_at_x)[()]
+
+    @counted('pdf')
     def pdf(self, x):
-        index = bisect.bisect_right(self.bin_edges, x)-1
-        if index == len(self.pdf_at_centers):
-            return 0.0
-        return self.pdf_at_centers[index]
+        x = np.asarray(x, dtype=float)
+        index = np.searchsorted(self.bin_edges, x, side='right')-1
+        last = len(self.pdf_at_centers)
+        inside = (index >= 0) & (index < last)
+        pdf_at_x = self.pdf_at_centers[index.clip(0, last-1)]
+        return np.where(inside, pdf_at_x, 0.0)[()]
 
+    def bin_mass(self):
+        return self.pdf_bin_sum
+
+    @counted('ppf')
     def ppf(self, cdf_at_x):
-        index = bisect.bisect_right(self.cdf_bin_sum, cdf_at_x)-1
-        if index == len(self.cdf_bin_sum)-1:
-            # case: cdf_at_x = 1
-            return 1.0
+        cdf_at_x = np.asarray(cdf_at_x, dtype=float)
+        cdf_bin_sum = self.cdf_bin_sum
+        index = np.searchsorted(cdf_bin_sum, cdf_at_x, side='right')-1
+        last = len(cdf_bin_sum)-1
+        bin_index = np.minimum(index, last-1)
         # special case: left edge
-        x = self.bin_edges[index] if index >= 0 else self.begin
-        ppf_bin_width = self.cdf_bin_sum[index+1]-self.cdf_bin_sum[index]
-        weight = (cdf_at_x-self.cdf_bin_sum[index])/ppf_bin_width
-        x += weight*self.bin_width[index]
-        return x
+        x = np.where(bin_index >= 0, self.bin_edges[bin_index], self.begin)
+        ppf_bin_width = cdf_bin_sum[bin_index+1]-cdf_bin_sum[bin_index]
+        with np.errstate(divide='ignore', invalid='ignore'):
+            weight = (cdf_at_x-cdf_bin_sum[bin_index])/ppf_bin_width
+        x = x + weight*self.bin_width[bin_index]
+        # case: cdf_at_x = 1
+        return np.where(index == last, 1.0, x)[()]
 
     def _quantized_sum_pdf(self):
         bin_edges = self.bin_edges
@@ -151,20 +391,80 @@ class HistDistribution(Distribution):
         return pdfb
 
 
-class TruncNorm(Distribution):
+class TruncNormMixture(Distribution):
+    """Mixture of truncated normals. Integrals of polynomials times the pdf
+    over an interval have closed forms in the normal pdf and cdf at the
+    interval ends, so no numerical integration is needed. All methods
+    broadcast over arrays of levels.
+    """
+
+    def _components(self):
+        """Means, sigmas and weights of the components."""
+        raise NotImplementedError('Components have not been implemented.')
+
+    def _standard_moments(self, left_level, right_level):
+        # int_c^d u^k phi(u) du for k=0,1,2 in standardized coordinates,
+        # one column per component
+        means, sigmas, weights = self._components()
+        c = np.asarray(left_level, dtype=np.float64)[..., np.newaxis]
+        d = np.asarray(right_level, dtype=np.float64)[..., np.newaxis]
+        zc = (c - means) / sigmas
+        zd = (d - means) / sigmas
+        a = (self.begin - means) / sigmas
+        b = (self.end - means) / sigmas
+        lo = np.clip(zc, a, b)
+        hi = np.clip(zd, a, b)
+        pdf_lo = _normal_pdf(lo)
+        pdf_hi = _normal_pdf(hi)
+        p0 = _normal_interval_mass(lo, hi)
+        p1 = pdf_lo - pdf_hi
+        p2 = p0 + lo * pdf_lo - hi * pdf_hi
+        # weight of a component divided by its truncated mass
+        weights = weights / _normal_interval_mass(a, b)
+        return zc, zd, p0, p1, p2, sigmas, weights
+
+    def _first_moment(self, left_level, right_level, center):
+        # int_c^d (x - center) f(x) dx
+        zc, zd, p0, p1, _, sigmas, weights = self._standard_moments(
+            left_level, right_level)
+        means, _, _ = self._components()
+        zcenter = (np.asarray(center, dtype=np.float64)[..., np.newaxis]
+                   - means) / sigmas
+        return np.sum(weights * sigmas * (p1 - zcenter * p0), axis=-1)
+
+    def est_var_pgd_adj_levels(self, left_level, current_level, right_level):
+        return (self._first_moment(left_level, current_level, left_level)
+                + self._first_moment(current_level, right_level, right_level))
+
+    def est_var_adjacent_levels(self, left_level, right_level):
+        # int_c^d (x - c) (d - x) f(x) dx
+        zc, zd, p0, p1, p2, sigmas, weights = self._standard_moments(
+            left_level, right_level)
+        var = -zc * zd * p0 + (zc + zd) * p1 - p2
+        return np.sum(weights * sigmas ** 2 * var, axis=-1)
+
+    def estimate_variance_adj_inv(self, left_level, right_level):
+        # calculate Eq 8 of the paper
+        # ppf(cdf(d) - int_c^d (r - c) * pdf(r) dr / (d - c))
+        c = left_level
+        d = right_level
+        intg_by_intg = self._first_moment(c, d, c)
+        inv_arg = self.cdf(d) - intg_by_intg / (d - c)
+        return self.ppf(inv_arg)
+
+
+class TruncNorm(TruncNormMixture):
 
     def __init__(self, mean, sigma, begin=-1, end=+1, nbins=100,
                  bin_type='linear'):
-        super().__init__(begin, end, nbins, bin_type)
-
         self.mean = mean
         self.sigma = sigma
-        self.begin = begin
-        self.end = end
         self.nbins = nbins
         self.a = (begin - self.mean) / self.sigma
         self.b = (end - self.mean) / self.sigma
+        super().__init__(begin, end, nbins, bin_type)
 
+    @counted('cdf')
     def cdf(self, x):
         a = self.a
         b = self.b
@@ -172,6 +472,7 @@ class TruncNorm(Distribution):
         sigma = self.sigma
         return truncnorm.cdf(x, a, b, loc=mu, scale=sigma)
 
+    @counted('pdf')
     def pdf(self, x):
         a = self.a
         b = self.b
@@ -179,6 +480,7 @@ class TruncNorm(Distribution):
         sigma = self.sigma
         return truncnorm.pdf(x, a, b, loc=mu, scale=sigma)
 
+    @counted('ppf')
     def ppf(self, x):
         a = self.a
         b = self.b
@@ -186,8 +488,12 @@ class TruncNorm(Distribution):
         sigma = self.sigma
         return truncnorm.ppf(x, a, b, loc=mu, scale=sigma)
 
+    def _components(self):
+        return (np.array([self.mean], dtype=np.float64),
+                np.array([self.sigma], dtype=np.float64), np.ones(1))
 
-class CondNormalTrunc(Distribution):
+
+class CondNormalTrunc(TruncNormMixture):
 
     def __init__(self, means, sigmas, norms, begin=-1, end=1,
                  nbins=1000, bin_type='linear'):
@@ -203,93 +509,189 @@ class CondNormalTrunc(Distribution):
         self.b = (end - self.means) / self.sigmas
         self.coeff = self.norms / self.total_norm
 
+    @counted('cdf')
     def cdf(self, x):
         cdfs = truncnorm.cdf(
-            x, self.a, self.b, loc=self.means, scale=self.sigmas)
-        return np.sum(np.dot(cdfs, self.coeff))
+            np.asarray(x)[..., None], self.a, self.b, loc=self.means,
+            scale=self.sigmas)
+        return np.dot(cdfs, self.coeff)
 
+    @counted('pdf')
     def pdf(self, x):
         pdfs = truncnorm.pdf(
-            x, self.a, self.b, loc=self.means, scale=self.sigmas)
-        return np.sum(np.dot(pdfs, self.coeff))
+            np.asarray(x)[..., None], self.a, self.b, loc=self.means,
+            scale=self.sigmas)
+        return np.dot(pdfs, self.coeff)
 
+    @counted('ppf')
+    def ppf(self, cdf_at_x):
+        # bisection on the mixture cdf
+        cdf_at_x = np.asarray(cdf_at_x, dtype=np.float64)
+        lo = np.full(cdf_at_x.shape, float(self.begin))
+        hi = np.full(cdf_at_x.shape, float(self.end))
+        for _ in range(60):
+            mid = (lo + hi) / 2
+            below = self.cdf(mid) < cdf_at_x
+            lo = np.where(below, mid, lo)
+            hi = np.where(below, hi, mid)
+        return ((lo + hi) / 2)[()]
 
-class CondNormalTruncHist(Distribution):
+    def _components(self):
+        return self.means, self.sigmas, self.coeff
+
+
+class CondNormalTruncHist(HistDistribution):
 
     def __init__(self, means, sigmas, norms, begin=-1, end=+1, nbins=100,
-                 bin_type='linear'):
-        super().__init__(begin, end, nbins, bin_type)
-        mu = self.means = np.asarray(means)
-        sigma = self.sigmas = np.asarray(sigmas)
-        bin_edges = self.bin_edges
+                 bin_type='linear', pdf_bin_sum=None, bin_edges=None):
+        self.means = np.asarray(means)
+        self.sigmas = np.asarray(sigmas)
         self.norms = np.asarray(norms)
-        self.begin = begin
-        self.end = end
         self.nbins = nbins
         self.total_norm = np.sum(self.norms)
-        a_vals = self.a = (begin - self.means) / self.sigmas
-        b_vals = self.b = (end - self.means) / self.sigmas
+        self.a = (begin - self.means) / self.sigmas
+        self.b = (end - self.means) / self.sigmas
         self.coeff = self.norms / self.total_norm
-
-        def cdf_f(x):
-            from scipy import stats
-            cdf_val = 0.0
-            for m, s, n, a_val, b_val in zip(mu, sigma, norms, a_vals, b_vals):
-                coeff = n / self.total_norm
-                cdf_val += coeff * stats.truncnorm.cdf(x, loc=m, scale=s,
-                                                       a=a_val, b=b_val)
-            return cdf_val
-
-        self.pdf_bin_sum = self._quantized_sum_pdf()
-        self.cdf_bin_sum = np.cumsum(self.pdf_bin_sum).clip(0, 1)
-        # self.ppf_bin_width = (self.cdf_bin_sum[1:]-self.cdf_bin_sum[:-1])
-        self.pdf_at_centers = self.pdf_bin_sum / self.bin_width
-        
+        super().__init__(None, begin, end, nbins, bin_type, pdf_bin_sum,
+                         bin_edges)
 
     def _quantized_sum_pdf(self):
-        from scipy import stats
-        mu = self.means
-        sigma = self.sigmas
-        norms = self.norms
-        a_vals = self.a
-        b_vals = self.b
-        bin_edges = self.bin_edges
-        pdf_bin_sum = 0
-        for m, s, n, a_val, b_val in zip(mu, sigma, norms, a_vals, b_vals):
-            cdfa = stats.truncnorm.cdf(bin_edges[:-1], loc=m, scale=s,
-                                       a=a_val, b=b_val)
-            cdfb = stats.truncnorm.cdf(bin_edges[1:], loc=m, scale=s,
-                                       a=a_val, b=b_val)
-            pdfb = cdfb-cdfa
-            pdfb /= pdfb.sum()
-            pdf_bin_sum = n / self.total_norm * pdfb + pdf_bin_sum
+        return self._mixture_bin_mass(self.bin_edges)
+
+    def _pilot_cdf(self, x):
+        return np.concatenate(([0.], np.cumsum(self._mixture_bin_mass(x))))
+
+    def _mixture_bin_mass(self, bin_edges):
+        # standardized bin edges, one row per mixture component
+        z = ((bin_edges[np.newaxis, :] - self.means[:, np.newaxis])
+             / self.sigmas[:, np.newaxis])
+        pdfb = _normal_interval_mass(z[:, :-1], z[:, 1:])
+        # truncation: every component is normalized over the bins
+        pdfb /= pdfb.sum(axis=1, keepdims=True)
+        pdf_bin_sum = self.coeff.dot(pdfb)
         pdf_bin_sum /= pdf_bin_sum.sum()
         return pdf_bin_sum
 
-    def cdf(self, x):
-        index = bisect.bisect_right(self.bin_edges, x)-1
-        if index == len(self.bin_edges)-1:
-            # case: x=self.end
-            return 1.0
-        cdf_at_x = self.cdf_bin_sum[index-1] if index > 0 else 0
-        weight = (x-self.bin_edges[index])/self.bin_width[index]
-        cdf_at_x += weight*self.pdf_bin_sum[index]
-        return cdf_at_x
 
-    def pdf(self, x):
-        index = bisect.bisect_right(self.bin_edges, x)-1
-        if index == len(self.pdf_at_centers):
-            return 0.0
-        return self.pdf_at_centers[index]
+class EmpiricalHist(HistDistribution):
+    """Histogram of the normalized gradient coordinates
 
-    def ppf(self, cdf_at_x):
-        index = bisect.bisect_right(self.cdf_bin_sum, cdf_at_x)-1
-        if index == len(self.cdf_bin_sum)-1:
-            # case: cdf_at_x = 1
-            return 1.0
-        # special case: left edge
-        x = self.bin_edges[index] if index >= 0 else self.begin
-        ppf_bin_width = self.cdf_bin_sum[index+1]-self.cdf_bin_sum[index]
-        weight = (cdf_at_x-self.cdf_bin_sum[index])/ppf_bin_width
-        x += weight*self.bin_width[index]
-        return x
+    Parameters:
+        counts (np.ndarray): counts of equally spaced bins on [begin, end]
+    """
+
+    def __init__(self, counts, begin=-1, end=+1):
+        self.counts = np.asarray(counts, dtype=np.float64)
+        super().__init__(None, begin, end, len(self.counts) + 1, 'linear')
+
+    def _quantized_sum_pdf(self):
+        return self.counts / self.counts.sum()
+
+    def blend(self, previous, weight):
+        super().blend(previous, weight)
+        self.counts = self.pdf_bin_sum * self.counts.sum()
+
+
+class QuantileSketch(object):
+    """Mergeable streaming quantile sketch (KLL style compactors)
+
+    Level h holds values that stand for 2^h samples each. A level that
+    grows beyond `size` values is sorted and every other value, starting
+    at a random offset, moves up a level. Memory is O(size log(n/size)).
+
+    Parameters:
+        size (int): capacity of every level
+    """
+
+    def __init__(self, size=2048):
+        self.size = size
+        self.compactors = []
+        self.count = 0
+
+    def update(self, x):
+        """Insert a batch of values
+
+        Parameters:
+            x (torch.Tensor): values on any device; a large batch is sorted
+                              and subsampled on its device before the
+                              transfer to the host
+        """
+        x = x.flatten()
+        n = x.numel()
+        if n == 0:
+            return
+        self.count += n
+        level = max(0, int(np.ceil(np.log2(n / self.size))))
+        if level > 0:
+            # the same as compacting the batch level times
+            x = torch.sort(x)[0]
+            x = x[np.random.randint(2 ** level)::2 ** level]
+        self._insert(level, x.cpu().numpy().astype(np.float64))
+
+    def merge(self, other):
+        """Add the values of another sketch"""
+        self.count += other.count
+        for level, values in enumerate(other.compactors):
+            self._insert(level, values)
+
+    def _insert(self, level, values):
+        while len(self.compactors) <= level:
+            self.compactors.append(np.zeros(0))
+        self.compactors[level] = np.concatenate(
+            (self.compactors[level], values))
+        for h in range(level, len(self.compactors)):
+            if len(self.compactors[h]) <= self.size:
+                continue
+            values = np.sort(self.compactors[h])
+            if len(values) % 2 == 1:
+                # an odd value out stays on this level
+                self.compactors[h] = values[-1:]
+                values = values[:-1]
+            else:
+                self.compactors[h] = np.zeros(0)
+            if h + 1 == len(self.compactors):
+                self.compactors.append(np.zeros(0))
+            self.compactors[h + 1] = np.concatenate(
+                (self.compactors[h + 1], values[np.random.randint(2)::2]))
+
+    def items(self):
+        """Sorted values and their weights"""
+        values = np.concatenate(self.compactors)
+        weights = np.concatenate([np.full(len(c), 2. ** h)
+                                  for h, c in enumerate(self.compactors)])
+        order = np.argsort(values, kind='stable')
+        return values[order], weights[order]
+
+    def state_dict(self):
+        return {'size': self.size, 'compactors': self.compactors,
+                'count': self.count}
+
+    def load_state_dict(self, state):
+        self.size = state['size']
+        self.compactors = state['compactors']
+        self.count = state['count']
+
+
+class SketchHist(HistDistribution):
+    """Histogram with bins at the quantiles of a QuantileSketch, so the
+    resolution follows the data instead of a fixed grid over the interval
+
+    Parameters:
+        sketch (QuantileSketch): sketch of the normalized coordinates
+        nbins (int): maximum number of bin edges
+    """
+
+    def __init__(self, sketch, begin=-1, end=+1, nbins=1000):
+        values, weights = sketch.items()
+        values = values.clip(begin, end)
+        # piecewise linear cdf through the sketch values at the midpoints
+        # of their weights, from 0 at the smallest value to 1 at the
+        # largest, so there is no mass outside of the sketched range
+        cdf = np.cumsum(weights) - weights / 2
+        cdf = (cdf - cdf[0]) / (cdf[-1] - cdf[0])
+        bin_edges = np.interp(np.linspace(0, 1, nbins), cdf, values)
+        bin_edges = np.unique(np.concatenate(([begin, end], bin_edges)))
+        pdf_bin_sum = np.diff(np.interp(bin_edges, values, cdf,
+                                        left=0, right=1))
+        super().__init__(None, begin, end, bin_edges=bin_edges,
+                         pdf_bin_sum=pdf_bin_sum)
@@ -0,0 +1,289 @@
+"""Torch implementations of the distributions of estim/dist.py
+
+The distributions keep their parameters and tables on the device of the
+gradients, so the statistics of a snapshot never have to be copied to the
+host to fit the levels. Only linear bins are supported.
+"""
+import math
+
+import numpy as np
+import torch
+
+from .dist import TruncNorm, CondNormalTruncHist
+
+
+def _as_tensor(x, device, dtype=torch.float64):
+    if isinstance(x, (list, tuple)):
+        x = [torch.as_tensor(v, dtype=dtype, device=device) for v in x]
+        return torch.stack(x) if len(x) > 0 else torch.zeros(
+            0, dtype=dtype, device=device)
+    return torch.as_tensor(x, dtype=dtype, device=device)
+
+
+def _normal_cdf(z):
+    return 0.5 * torch.erfc(-z / math.sqrt(2))
+
+
+def _normal_pdf(z):
+    return torch.exp(-z ** 2 / 2) / math.sqrt(2 * math.pi)
+
+
+def _normal_interval_mass(za, zb):
+    """Standard normal mass of [za, zb] (za <= zb) computed from tail
+    masses so that it stays accurate far from the mean.
+    """
+    ta = _normal_cdf(-za.abs())
+    tb = _normal_cdf(-zb.abs())
+    return torch.where(za >= 0, ta - tb,
+                       torch.where(zb <= 0, tb - ta, 1 - ta - tb))
+
+
+class TorchDistribution(object):
+    """Distribution on [begin, end] with cumulative moment tables over
+    linear bins, the torch counterpart of estim.dist.Distribution.
+    """
+
+    def __init__(self, begin=-1, end=+1, nbins=1000, device='cpu'):
+        self.begin = begin
+        self.end = end
+        self.nbins = nbins
+        self.device = torch.device(device)
+        self.bin_edges = torch.linspace(
+            begin, end, nbins, dtype=torch.float64, device=self.device)
+        self.bin_width = self.bin_edges[1:] - self.bin_edges[:-1]
+        self._moment_tables = None
+
+    def _tensor(self, x):
+        return _as_tensor(x, self.device)
+
+    def bin_mass(self):
+        """Probability mass of every bin."""
+        mass = self.cdf(self.bin_edges)
+        mass = mass[1:] - mass[:-1]
+        return mass / mass.sum()
+
+    def moment_tables(self):
+        """Cumulative zeroth, first and second moments at the bin edges
+        assuming the density is uniform inside every bin.
+        """
+        if self._moment_tables is None:
+            mass = self.bin_mass()
+            left = self.bin_edges[:-1]
+            right = self.bin_edges[1:]
+            moments = (mass,
+                       mass * (left + right) / 2,
+                       mass * (left ** 2 + left * right + right ** 2) / 3)
+            zero = mass.new_zeros(1)
+            self._moment_tables = [
+                torch.cat((zero, torch.cumsum(m, 0))) for m in moments]
+        return self._moment_tables
+
+    def partial_moments(self, x):
+        """Zeroth, first and second moments of the density on [begin, x].
+
+        Parameters:
+            x (torch.Tensor): points to evaluate the moments at
+        """
+        m0, m1, m2 = self.moment_tables()
+        bin_edges = self.bin_edges
+        x = self._tensor(x).clamp(self.begin, self.end)
+        index = torch.searchsorted(
+            bin_edges, x.contiguous(), right=True) - 1
+        index = index.clamp(0, len(bin_edges) - 2)
+        left = bin_edges[index]
+        density = (m0[index + 1] - m0[index]) / self.bin_width[index]
+        return (m0[index] + density * (x - left),
+                m1[index] + density * (x ** 2 - left ** 2) / 2,
+                m2[index] + density * (x ** 3 - left ** 3) / 3)
+
+    def est_var_adjacent_levels(self, left_level, right_level):
+        # int_c^d (x - c) (d - x) f(x) dx from the moment tables
+        c = self._tensor(left_level)
+        d = self._tensor(right_level)
+        m0, m1, m2 = self.partial_moments(torch.stack((c, d)))
+        return (-c * d * (m0[1] - m0[0]) + (c + d) * (m1[1] - m1[0])
+                - (m2[1] - m2[0]))
+
+    def estimate_variance(self, levels):
+        levels = self._tensor(levels)
+        return self.est_var_adjacent_levels(levels[:-1], levels[1:]).sum()
+
+    def estimate_variance_batch(self, levels_matrix):
+        """Variance of every row of a (candidates x levels) tensor computed
+        in one pass.
+        """
+        levels = self._tensor(levels_matrix)
+        return self.est_var_adjacent_levels(
+            levels[:, :-1], levels[:, 1:]).sum(dim=1)
+
+
+class TorchTruncNorm(TorchDistribution):
+    """Truncated normal with closed form moments, see estim.dist.TruncNorm
+
+    Parameters:
+        mean (float or torch.Tensor): mean of the normal
+        sigma (float or torch.Tensor): standard deviation of the normal
+    """
+
+    def __init__(self, mean, sigma, begin=-1, end=+1, nbins=100,
+                 device='cpu'):
+        super().__init__(begin, end, nbins, device)
+        self.mean = self._tensor(mean)
+        self.sigma = self._tensor(sigma)
+        self.a = (begin - self.mean) / self.sigma
+        self.b = (end - self.mean) / self.sigma
+        self.mass = _normal_interval_mass(self.a, self.b)
+
+    def cdf(self, x):
+        z = self._standardize(x)
+        return _normal_interval_mass(self.a.expand_as(z), z) / self.mass
+
+    def pdf(self, x):
+        x = self._tensor(x)
+        z = (x - self.mean) / self.sigma
+        inside = (x >= self.begin) & (x <= self.end)
+        return torch.where(inside, _normal_pdf(z) / (self.sigma * self.mass),
+                           torch.zeros_like(z))
+
+    def ppf(self, x):
+        x = self._tensor(x)
+        p = _normal_cdf(self.a) + x * self.mass
+        z = math.sqrt(2) * torch.erfinv(
+            (2 * p - 1).clamp(-1 + 1e-16, 1 - 1e-16))
+        return (self.mean + self.sigma * z).clamp(self.begin, self.end)
+
+    def _standardize(self, x):
+        z = (self._tensor(x) - self.mean) / self.sigma
+        return torch.max(torch.min(z, self.b), self.a)
+
+    def est_var_adjacent_levels(self, left_level, right_level):
+        # int_c^d (x - c) (d - x) f(x) dx in closed form
+        zc = (self._tensor(left_level) - self.mean) / self.sigma
+        zd = (self._tensor(right_level) - self.mean) / self.sigma
+        lo = torch.max(torch.min(zc, self.b), self.a)
+        hi = torch.max(torch.min(zd, self.b), self.a)
+        pdf_lo = _normal_pdf(lo)
+        pdf_hi = _normal_pdf(hi)
+        p0 = _normal_interval_mass(lo, hi)
+        p1 = pdf_lo - pdf_hi
+        p2 = p0 + lo * pdf_lo - hi * pdf_hi
+        var = -zc * zd * p0 + (zc + zd) * p1 - p2
+        return self.sigma ** 2 * var / self.mass
+
+    def to_numpy(self):
+        return TruncNorm(self.mean.item(), self.sigma.item(), self.begin,
+                         self.end, nbins=self.nbins)
+
+
+class TorchCondNormalTruncHist(TorchDistribution):
+    """Binned mixture of truncated normals, see
+    estim.dist.CondNormalTruncHist
+
+    Parameters:
+        means (torch.Tensor): means of the components
+        sigmas (torch.Tensor): standard deviations of the components
+        norms (torch.Tensor): weights of the components
+    """
+
+    def __init__(self, means, sigmas, norms, begin=-1, end=+1, nbins=100,
+                 device='cpu', pdf_bin_sum=None):
+        super().__init__(begin, end, nbins, device)
+        self.means = self._tensor(means)
+        self.sigmas = self._tensor(sigmas)
+        self.norms = self._tensor(norms)
+        self.coeff = self.norms / self.norms.sum()
+        self.a = (begin - self.means) / self.sigmas
+        self.b = (end - self.means) / self.sigmas
+        if pdf_bin_sum is None:
+            pdf_bin_sum = self._mixture_bin_mass(self.bin_edges)
+        self.pdf_bin_sum = self._tensor(pdf_bin_sum)
+        self._set_tables()
+
+    def _mixture_bin_mass(self, bin_edges):
+        # standardized bin edges, one row per mixture component
+        z = ((bin_edges[None, :] - self.means[:, None])
+             / self.sigmas[:, None])
+        pdfb = _normal_interval_mass(z[:, :-1], z[:, 1:])
+        # truncation: every component is normalized over the bins
+        pdfb = pdfb / pdfb.sum(dim=1, keepdim=True)
+        pdf_bin_sum = self.coeff.matmul(pdfb)
+        return pdf_bin_sum / pdf_bin_sum.sum()
+
+    def _set_tables(self):
+        self.pdf_bin_sum = self.pdf_bin_sum / self.pdf_bin_sum.sum()
+        self.cdf_bin_sum = torch.cumsum(self.pdf_bin_sum, 0).clamp(0, 1)
+        self.pdf_at_centers = self.pdf_bin_sum / self.bin_width
+        self._moment_tables = None
+
+    def blend(self, previous, weight):
+        """Replace the tables by weight * self + (1 - weight) * previous
+
+        Parameters:
+            previous (TorchDistribution): distribution of an older snapshot
+            weight (float): weight of this distribution
+        """
+        self.pdf_bin_sum = (weight * self.pdf_bin_sum
+                            + (1 - weight) * previous.bin_mass())
+        self._set_tables()
+
+    def bin_mass(self):
+        return self.pdf_bin_sum
+
+    def cdf(self, x):
+        x = self._tensor(x)
+        last = len(self.bin_edges) - 1
+        index = torch.searchsorted(
+            self.bin_edges, x.contiguous(), right=True) - 1
+        bin_index = index.clamp(0, last - 1)
+        cdf_at_x = torch.where(
+            bin_index > 0, self.cdf_bin_sum[(bin_index - 1).clamp(min=0)],
+            torch.zeros_like(x))
+        weight = (x - self.bin_edges[bin_index]) / self.bin_width[bin_index]
+        cdf_at_x = cdf_at_x + weight * self.pdf_bin_sum[bin_index]
+        cdf_at_x = torch.where(index >= last, torch.ones_like(x), cdf_at_x)
+        return torch.where(index < 0, torch.zeros_like(x), cdf_at_x)
+
+    def pdf(self, x):
+        x = self._tensor(x)
+        last = len(self.pdf_at_centers)
+        index = torch.searchsorted(
+            self.bin_edges, x.contiguous(), right=True) - 1
+        inside = (index >= 0) & (index < last)
+        pdf_at_x = self.pdf_at_centers[index.clamp(0, last - 1)]
+        return torch.where(inside, pdf_at_x, torch.zeros_like(x))
+
+    def ppf(self, cdf_at_x):
+        cdf_at_x = self._tensor(cdf_at_x)
+        cdf_bin_sum = self.cdf_bin_sum
+        last = len(cdf_bin_sum) - 1
+        index = torch.searchsorted(
+            cdf_bin_sum, cdf_at_x.contiguous(), right=True) - 1
+        bin_index = index.clamp(max=last - 1)
+        safe_index = bin_index.clamp(min=0)
+        # special case: left edge, below the first bin the NumPy ppf wraps
+        # around to the last bin, here it returns begin
+        x = torch.where(bin_index >= 0, self.bin_edges[safe_index],
+                        torch.full_like(cdf_at_x, self.begin))
+        ppf_bin_width = cdf_bin_sum[safe_index + 1] - cdf_bin_sum[safe_index]
+        weight = (cdf_at_x - cdf_bin_sum[safe_index]) / ppf_bin_width
+        weight = torch.where(bin_index >= 0, weight, torch.zeros_like(x))
+        x = x + weight * self.bin_width[safe_index]
+        # case: cdf_at_x = 1
+        return torch.where(index == last, torch.ones_like(x), x)
+
+    def to_numpy(self):
+        return CondNormalTruncHist(
+            self.means.cpu().numpy(), self.sigmas.cpu().numpy(),
+            self.norms.cpu().numpy(), self.begin, self.end,
+            nbins=self.nbins, pdf_bin_sum=self.pdf_bin_sum.cpu().numpy())
+
+
+def to_torch(dist, device='cpu'):
+    """Torch copy of a NumPy TruncNorm or CondNormalTruncHist"""
+    if isinstance(dist, TruncNorm):
+        return TorchTruncNorm(dist.mean, dist.sigma, dist.begin, dist.end,
+                              dist.nbins, device)
+    return TorchCondNormalTruncHist(
+        np.asarray(dist.means), np.asarray(dist.sigmas),
+        np.asarray(dist.norms), dist.begin, dist.end,
+        len(dist.bin_edges), device, pdf_bin_sum=dist.pdf_bin_sum)
@@ -7,6 +7,30 @@ import copy
 import logging
 
 from data import InfiniteLoader
+from log_utils import StageTimer
+from .dist import reduce_mixture, QuantileSketch
+
+try:
+    from torch.func import functional_call, grad as func_grad, vmap
+except ImportError:
+    # torch < 2.0, the snapshot gradients are computed one at a time
+    vmap = None
+
+
+class _FunctionalModel(object):
+    """Calls a module with the given parameters and buffers, for criteria
+    that take the model as an argument
+    """
+
+    def __init__(self, module, tensors):
+        self.module = module
+        self.tensors = tensors
+
+    def zero_grad(self):
+        pass
+
+    def __call__(self, *args):
+        return functional_call(self.module, self.tensors, args)
 
 
 class GradientEstimator(object):
@@ -17,6 +41,8 @@ class GradientEstimator(object):
         self.tb_logger = tb_logger
         self.niters = 0
         self.random_indices = None
+        # host syncs after every stage only when a trace is dumped
+        self.snap_timer = StageTimer(sync=opt.snap_trace)
 
     def update_niters(self, niters):
         self.niters = niters
@@ -37,101 +63,355 @@ class GradientEstimator(object):
         model.zero_grad()
         data = next(self.data_iter)
         loss = model.criterion(model, data)
-        grad = torch.autograd.grad(loss, model.parameters())
+        if getattr(model, 'flat_buffer', None) is not None:
+            # views of the flat gradient, valid until the next call
+            loss.backward()
+            grad = tuple(p.grad for p in model.parameters())
+        else:
+            grad = torch.autograd.grad(loss, model.parameters())
         self.data_iter = dt
         return grad
 
-    def _bucketize(self, grad, bs, stats_nb):
-        """Calculate the stats for a single bucket
+    def _vmap_compatible(self, model):
+        """Batch norm in train mode mixes the samples of a batch and its
+        running statistics cannot be updated inside vmap
+        """
+        if vmap is None:
+            return False
+        return not any(
+            isinstance(m, torch.nn.modules.batchnorm._BatchNorm)
+            and m.training for m in model.modules())
+
+    def _get_raw_grads_vmap(self, model, num_of_samples):
+        """Gradients of num_of_samples mini-batches of the estimator loader
+        computed in one batched pass
+        """
+        batches = [next(self.estim_iter) for i in range(num_of_samples)]
+        if len(set(len(data[1]) for data in batches)) > 1:
+            # a short last batch cannot be stacked
+            for data in batches:
+                yield torch.autograd.grad(
+                    model.criterion(model, data), model.parameters())
+            return
+        module = model.module if isinstance(
+            model, torch.nn.DataParallel) else model
+        names = [name for name, _ in module.named_parameters()]
+        params = {name: p.detach() for name, p in module.named_parameters()}
+        buffers = dict(module.named_buffers())
+
+        def batch_loss(params, data, target):
+            return model.criterion(
+                _FunctionalModel(module, (params, buffers)), (data, target))
+
+        # the batches go to the device of the model, CPU or GPU
+        device = next(iter(params.values())).device
+        grads = vmap(func_grad(batch_loss), in_dims=(None, 0, 0),
+                     randomness='different')(
+            params,
+            torch.stack([data[0] for data in batches]).to(device),
+            torch.stack([data[1] for data in batches]).to(device))
+        for i in range(num_of_samples):
+            yield tuple(grads[name][i] for name in names)
+
+    def _bucket_view(self, grad, bs):
+        """(buckets x bucket size) view of a gradient vector padded with
+        zeros, the number of coordinates of every bucket and in total
+        """
+        length = len(grad)
+        if self.opt.nuq_ig_sm_bkts:
+            length = length // bs * bs
+        num_buckets = int(np.ceil(length / bs))
+        padded = grad.new_zeros(num_buckets * bs)
+        padded[:length] = grad[:length]
+        padded = padded.view(num_buckets, bs)
+        # only the last bucket can be shorter than the bucket size
+        b_lens = torch.full((num_buckets, 1), bs, dtype=grad.dtype,
+                            device=grad.device)
+        if num_buckets > 0:
+            b_lens[-1] = length - (num_buckets - 1) * bs
+        return padded, b_lens, length
+
+    def _sample_buckets(self, grad, bs, num_samples, strata=4):
+        """Random subset of the buckets of a gradient vector and the
+        importance weights that keep the sums over the buckets unbiased
+        Parameters:
+            grad (torch.Tensor): gradient vector
+            bs (int): bucket size
+            num_samples (int): number of buckets to keep
+            strata (int): number of norm quantiles sampled equally with the
+                          norm sampling
+        """
+        padded, _, _ = self._bucket_view(grad, bs)
+        num_buckets = len(padded)
+        if num_buckets <= num_samples:
+            return None
+        if self.opt.nuq_bucket_sample_type == 'norm':
+            # equal number of buckets from every norm stratum
+            order = torch.argsort(padded.norm(dim=1))
+            groups = torch.chunk(order, min(strata, num_samples))
+        else:
+            groups = [torch.arange(num_buckets, device=grad.device)]
+        indexes = []
+        weights = []
+        for group, count in zip(groups, np.array_split(
+                np.arange(num_samples), len(groups))):
+            choice = torch.randperm(len(group), device=grad.device)[
+                :len(count)]
+            indexes.append(group[choice])
+            weights.append(torch.full((len(choice), 1),
+                                      len(group) / len(choice),
+                                      dtype=grad.dtype, device=grad.device))
+        return torch.cat(indexes), torch.cat(weights)
+
+    def _bucketize(self, grad, bs, stats_nb, sample=None):
+        """Calculate the stats of all the buckets of a gradient vector in a
+        few batched reductions over a (buckets x bucket size) view
         Parameters:
             grad (torch.Tensor): gradient vector
             bs (int): bucket size
             stats_nb (dict): dictionary containing norm-based statistics
+            sample (tuple): indexes and importance weights of a subset of
+                            the buckets from _sample_buckets
+        """
+        padded, b_lens, length = self._bucket_view(grad, bs)
+        weights = 1
+        if sample is not None:
+            indexes, weights = sample
+            padded = padded[indexes]
+            b_lens = b_lens[indexes]
+        mask = (torch.arange(bs, device=grad.device)[None, :]
+                < b_lens).to(grad.dtype)
+
+        norms = padded.norm(dim=1, keepdim=True)
+        normalized = padded / norms
+        sums = normalized.sum(dim=1, keepdim=True)
+        means = sums / b_lens
+        # two-pass unbiased variance like torch.var
+        var = ((normalized - means) * mask).pow(2).sum(
+            dim=1, keepdim=True) / (b_lens - 1)
+
+        # the norms are the weights of the mixture components
+        stats_nb['norms'].append((norms * weights).view(-1))
+        stats_nb['sigmas'].append(torch.sqrt(var).view(-1))
+        stats_nb['means'].append(means.view(-1))
+
+        # norm-less variance and sum
+        variance = (var * (b_lens - 1) * weights).sum()
+        tot_sum = (sums * weights).sum()
+        if sample is not None:
+            length = (b_lens * weights).sum()
+        return tot_sum, variance, length
+
+    def _normalized_coords(self, grad, bs):
+        """Coordinates of a gradient vector divided by the norm of their
+        bucket, computed on the device of the gradient
+        Parameters:
+            grad (torch.Tensor): gradient vector
+            bs (int): bucket size
+        """
+        length = len(grad)
+        if self.opt.nuq_ig_sm_bkts:
+            length = length // bs * bs
+        num_buckets = int(np.ceil(length / bs))
+        padded = torch.zeros(num_buckets * bs, device=grad.device,
+                             dtype=grad.dtype)
+        padded[:length] = grad[:length]
+        padded = padded.view(num_buckets, bs)
+        normalized = padded / (padded.norm(dim=1, keepdim=True) + 1e-7)
+        # drop the padding of the last bucket
+        return normalized.view(-1)[:length]
+
+    def _histogram(self, grad, bs):
+        """Histogram of the normalized coordinates of a gradient vector
+        """
+        interval = self.opt.nuq_truncated_interval
+        normalized = self._normalized_coords(grad, bs)
+        return torch.histc(
+            normalized.clamp(-interval, interval),
+            bins=self.opt.nuq_hist_bins, min=-interval, max=interval)
+
+    def _layer_groups(self, grad):
+        """Assign every layer to a group that gets its own levels
+        """
+        if self.opt.nuq_level_groups == 'layer':
+            return list(range(len(grad)))
+        # 'ndim': convolutions, fully connected and 1-d layers
+        ndims = sorted(set(g.dim() for g in grad))
+        return [ndims.index(g.dim()) for g in grad]
+
+    def _top_buckets(self, stats_nb):
+        """Keep the dist_num buckets with the largest norms, selected on the
+        device of the statistics
+        """
+        means = torch.cat(stats_nb['means'])
+        sigmas = torch.cat(stats_nb['sigmas'])
+        norms = torch.cat(stats_nb['norms'])
+        if len(norms) > self.opt.dist_num:
+            # NaN norms are ranked last like in a sort
+            keys = torch.where(torch.isnan(norms),
+                               torch.full_like(norms, -float('inf')), norms)
+            indexes = torch.topk(keys, self.opt.dist_num)[1]
+            means = means[indexes]
+            sigmas = sigmas[indexes]
+            norms = norms[indexes]
+        return {'means': [means], 'sigmas': [sigmas], 'norms': [norms]}
+
+    def _bucket_stats(self, stats_nb, tot_sum, total_variance, total_params):
+        """Norm-based and norm-less stats from the bucket statistics
+        """
+        if self.opt.nuq_dist_reduce == 'topk':
+            stats_nb = self._top_buckets(stats_nb)
+        means = torch.cat(stats_nb['means'])
+        sigmas = torch.cat(stats_nb['sigmas'])
+        norms = torch.cat(stats_nb['norms'])
+        nl = torch.stack((tot_sum / total_params,
+                          torch.sqrt(total_variance / total_params)))
+        on_device = self.opt.nuq_dist_backend == 'torch'
+
+        if len(norms) > self.opt.dist_num:
+            # kmeans merges the statistics of all the buckets on the host
+            reduced = reduce_mixture(
+                means.cpu().numpy(), sigmas.cpu().numpy(),
+                norms.cpu().numpy(), self.opt.dist_num)
+            if not on_device:
+                mean, sigma = nl.cpu().tolist()
+                return {
+                    'nb': {'means': reduced[0].tolist(),
+                           'sigmas': reduced[1].tolist(),
+                           'norms': reduced[2].tolist()},
+                    'nl': {'mean': mean, 'sigma': sigma}
+                }
+            means, sigmas, norms = [torch.as_tensor(
+                v, dtype=nl.dtype, device=nl.device) for v in reduced]
+
+        if on_device:
+            return {
+                'nb': {'means': means, 'sigmas': sigmas, 'norms': norms},
+                'nl': {'mean': nl[0], 'sigma': nl[1]}
+            }
+        # a single transfer of the fixed-size statistics
+        host = torch.cat((means, sigmas, norms, nl)).cpu().tolist()
+        k = len(norms)
+        return {
+            'nb': {'means': host[:k], 'sigmas': host[k:2 * k],
+                   'norms': host[2 * k:3 * k]},
+            'nl': {'mean': host[-2], 'sigma': host[-1]}
+        }
+
+    def _bucket_samples(self, flattened, bs):
+        """Subsets of the buckets of every layer used by all the gradient
+        samples of a snapshot, the budget of nuq_bucket_sample buckets is
+        split in proportion to the number of buckets of the layers
         """
-        ig_sm_bkts = self.opt.nuq_ig_sm_bkts
-        variance = 0
-        num_params = 0
-        tot_sum = 0
-        num_buckets = int(np.ceil(len(grad) / bs))
-        for bucket in range(num_buckets):
-            start = bucket * bs
-            end = min((bucket + 1) * bs, len(grad))
-            current_bk = grad[start:end]
-            norm = current_bk.norm()
-            current_bk = current_bk / norm
-            b_len = len(current_bk)
-            if b_len != bs and ig_sm_bkts:
-                continue
-            num_params += b_len
-            var = torch.var(current_bk)
-
-            # update norm-less variance
-            variance += var * (b_len - 1)
-            tot_sum += torch.sum(current_bk)
-
-            stats_nb['norms'].append(norm)
-            stats_nb['sigmas'].append(torch.sqrt(var))
-            stats_nb['means'].append(torch.mean(current_bk))
-
-        return tot_sum, variance, num_params
+        total = self.opt.nuq_bucket_sample
+        if not total:
+            return [None] * len(flattened)
+        num_buckets = [int(np.ceil(len(layer) / bs)) for layer in flattened]
+        return [self._sample_buckets(
+                    layer, bs, int(np.ceil(total * n / sum(num_buckets))))
+                for layer, n in zip(flattened, num_buckets)]
 
     def snap_online_mean(self, model):
         """Sample the gradient and calculate the stats
         """
 
-        stats_nb = {
-            'means': [],
-            'sigmas': [],
-            'norms': []
-        }
-
-        total_variance = 0.0
-        tot_sum = 0.0
-
         num_of_samples = self.opt.nuq_number_of_samples
-        total_params = 0
         bs = self.opt.nuq_bucket_size
 
         lb = not self.opt.nuq_layer
-
-        for i in range(num_of_samples):
-            grad = self._get_raw_grad(model)
+        # per-group levels are only used with layer-wise quantization
+        per_group = lb and bool(self.opt.nuq_level_groups)
+        use_hist = self.opt.nuq_dist == 'hist'
+        use_sketch = self.opt.nuq_dist == 'sketch'
+        layer_groups = None
+        groups = {}
+        bucket_samples = None
+
+        flat_buffer = getattr(model, 'flat_buffer', None)
+        if self.opt.nuq_vmap_grads and self._vmap_compatible(model):
+            samples = self._get_raw_grads_vmap(model, num_of_samples)
+            flat_buffer = None
+        else:
+            samples = (self._get_raw_grad(model)
+                       for i in range(num_of_samples))
+        for grad in samples:
             if lb:
                 flattened = self._flatten_lb(grad)
-                for i, layer in enumerate(flattened):
-                    b_sum, b_var, b_params = self._bucketize(
-                        layer, bs, stats_nb)
-                    tot_sum += b_sum
-                    total_variance += b_var
-                    total_params += b_params
+            elif flat_buffer is not None:
+                # the gradient is a view of the flat buffer
+                flattened = [flat_buffer.grad]
             else:
-                flattened = self._flatten(grad)
+                flattened = [self._flatten(grad)]
+            if layer_groups is None:
+                layer_groups = (self._layer_groups(grad) if per_group
+                                else [0] * len(flattened))
+            if bucket_samples is None:
+                bucket_samples = self._bucket_samples(flattened, bs)
+            for layer, group, sample in zip(
+                    flattened, layer_groups, bucket_samples):
+                if group not in groups:
+                    groups[group] = {
+                        'nb': {'means': [], 'sigmas': [], 'norms': []},
+                        'sum': 0.0, 'variance': 0.0, 'params': 0,
+                        'hist': 0,
+                        'sketch': QuantileSketch(self.opt.nuq_sketch_size)}
+                acc = groups[group]
                 b_sum, b_var, b_params = self._bucketize(
-                    flattened, bs, stats_nb)
-                tot_sum += b_sum
-                total_variance += b_var
-                total_params += b_params
-
-        stats_nb['means'] = torch.stack(stats_nb['means']).cpu().tolist()
-        stats_nb['sigmas'] = torch.stack(stats_nb['sigmas']).cpu().tolist()
-        stats_nb['norms'] = torch.stack(stats_nb['norms']).cpu().tolist()
-
-        if len(stats_nb['means']) > self.opt.dist_num:
-            indexes = np.argsort(-np.asarray(stats_nb['norms']))[
-                :self.opt.dist_num]
-            stats_nb['means'] = np.array(stats_nb['means'])[indexes].tolist()
-            stats_nb['sigmas'] = np.array(stats_nb['sigmas'])[
-                indexes].tolist()
-            stats_nb['norms'] = np.array(stats_nb['norms'])[indexes].tolist()
-
-        stats = {
-            'nb': stats_nb,
-            'nl': {
-                'mean': (tot_sum / total_params).cpu().item(),
-                'sigma':
-                torch.sqrt(total_variance / total_params).cpu().item(),
-            }
+                    layer, bs, acc['nb'], sample)
+                if self.opt.nuq_dist_reduce == 'topk':
+                    # memory does not grow with the number of samples
+                    acc['nb'] = self._top_buckets(acc['nb'])
+                acc['sum'] += b_sum
+                acc['variance'] += b_var
+                acc['params'] += b_params
+                if use_hist:
+                    acc['hist'] = acc['hist'] + self._histogram(layer, bs)
+                if use_sketch:
+                    acc['sketch'].update(self._normalized_coords(layer, bs))
+
+        stats_nb = {
+            'means': [],
+            'sigmas': [],
+            'norms': []
         }
+        for acc in groups.values():
+            for key in stats_nb:
+                stats_nb[key] += acc['nb'][key]
+        stats = self._bucket_stats(
+            stats_nb,
+            sum(acc['sum'] for acc in groups.values()),
+            sum(acc['variance'] for acc in groups.values()),
+            sum(acc['params'] for acc in groups.values()))
+
+        if use_hist:
+            # a single transfer of the bin counts of all groups
+            hists = torch.stack(
+                [acc['hist'] for _, acc in sorted(groups.items())])
+            hists = hists.cpu().numpy()
+            stats['hist'] = hists.sum(axis=0)
+        if use_sketch:
+            # merge the sketches of the groups like those of workers
+            stats['sketch'] = QuantileSketch(self.opt.nuq_sketch_size)
+            for _, acc in sorted(groups.items()):
+                stats['sketch'].merge(acc['sketch'])
+
+        if per_group:
+            stats['layer_groups'] = layer_groups
+            # groups without any bucket (e.g. only small buckets that are
+            # ignored) use the global levels
+            stats['groups'] = [
+                self._bucket_stats(acc['nb'], acc['sum'], acc['variance'],
+                                   acc['params'])
+                if acc['params'] > 0 else None
+                for _, acc in sorted(groups.items())]
+            for index, (_, acc) in enumerate(sorted(groups.items())):
+                group_stats = stats['groups'][index]
+                if group_stats is None:
+                    continue
+                if use_hist:
+                    group_stats['hist'] = hists[index]
+                if use_sketch:
+                    group_stats['sketch'] = acc['sketch']
         return stats
 
     def grad(self, model_new, in_place=False, data=None):
@@ -162,6 +442,35 @@ class GradientEstimator(object):
         return ret
 
     def get_Ege_var(self, model, gviter):
+        if self.opt.gvar_two_pass:
+            return self._get_Ege_var_two_pass(model, gviter)
+        # estimate grad mean and variance in a single pass with Welford's
+        # updates
+        Ege = [torch.zeros_like(g) for g in model.parameters()]
+        M2 = [torch.zeros_like(g) for g in model.parameters()]
+        Es = [torch.zeros_like(g) for g in model.parameters()]
+        for i in range(gviter):
+            ge = self.grad_estim(model)
+            for e, m, s, g in zip(Ege, M2, Es, ge):
+                delta = g - e
+                e += delta / (i + 1)
+                m += delta * (g - e)
+                s += g.pow(2)
+
+        nw = sum([w.numel() for w in model.parameters()])
+        # Bessel's correction makes the estimate unbiased. The two-pass
+        # estimate measures deviations from the mean of other samples, its
+        # expectation is sigma^2 (n + 1) / n, so est_var and sgd_var are
+        # n / (n + 1) of those of --gvar_two_pass and of older logs
+        En = [m * gviter / max(gviter - 1, 1) for m in M2]
+        var_e = sum([nn.sum() for nn in En]) / nw / gviter
+        snr_e = sum(
+            [((ss+1e-10).log()-(nn+1e-10).log()).sum()
+             for ss, nn in zip(Es, En)])/nw
+        nv_e = sum([(nn/(ss+1e-7)).sum() for ss, nn in zip(Es, En)])/nw
+        return Ege, var_e, snr_e, nv_e
+
+    def _get_Ege_var_two_pass(self, model, gviter):
         # estimate grad mean and variance
         Ege = [torch.zeros_like(g) for g in model.parameters()]
         for i in range(gviter):
@@ -1,7 +1,10 @@
 import torch
 import torch.nn
 import torch.multiprocessing
+import logging
+import os
 
+from estim.dist import call_counts
 
 from estim.sgd import SGDEstimator
 from estim.nuq import NUQEstimator
@@ -64,18 +67,39 @@ class MinVarianceGradient(object):
                     number_of_negative_levels), step=niters)
                 if self.gest.qdq.error is not None:
                     tb_logger.log_value(
-                        'nb_error', self.gest.qdq.error, step=niters)
+                        'nb_error', float(self.gest.qdq.error), step=niters)
                 if self.gest.qdq.grad_dist_nl is not None:
                     tb_logger.log_value(
-                        'stats/mean', self.gest.qdq.grad_dist_nl.mean,
+                        'stats/mean', float(self.gest.qdq.grad_dist_nl.mean),
                         step=niters)
                     tb_logger.log_value(
-                        'stats/sigma', self.gest.qdq.grad_dist_nl.sigma,
+                        'stats/sigma',
+                        float(self.gest.qdq.grad_dist_nl.sigma),
+                        step=niters)
+                if self.gest.qdq.level_jitter is not None:
+                    tb_logger.log_value(
+                        'level_jitter', float(self.gest.qdq.level_jitter),
+                        step=niters)
+                if self.gest.qdq.group_levels is not None:
+                    tb_logger.log_value('level_groups', float(
+                        len(self.gest.qdq.group_levels)), step=niters)
+                levels_cache = self.gest.qdq.levels_cache
+                if levels_cache is not None:
+                    tb_logger.log_value(
+                        'levels_cache/hit_rate', levels_cache.hit_rate(),
+                        step=niters)
+                    tb_logger.log_value(
+                        'levels_cache/hits', levels_cache.hits, step=niters)
+                    tb_logger.log_value(
+                        'levels_cache/misses', levels_cache.misses,
                         step=niters)
 
             if self.opt.nuq_method == 'amq' or self.opt.nuq_method == 'amq_nb':
                 tb_logger.log_value('multiplier', float(
                     self.gest.qdq.multiplier), step=niters)
+                if self.gest.qdq.amq_evals is not None:
+                    tb_logger.log_value('amq_evals', float(
+                        self.gest.qdq.amq_evals), step=niters)
 
         print('est_var is', var_e)
         tb_logger.log_value('grad_bias', float(bias), step=niters)
@@ -91,6 +115,19 @@ class MinVarianceGradient(object):
                 'SGD N-Var: %.8f\t Est N-Var: %.8f\t'
                 % (43, sgd_x, var_s, est_x, var_e, nv_s, nv_e))
 
+    def log_snap(self, niters):
+        """Log the time of every stage of the last snapshot
+        """
+        timer = self.gest.snap_timer
+        logging.info('Snapshot %d: %s' % (niters, timer))
+        timer.tb_log(self.tb_logger, prefix='snap/', step=niters)
+        for name, count in call_counts.items():
+            self.tb_logger.log_value(
+                'snap/%s_calls' % name, count, step=niters)
+        if self.opt.snap_trace:
+            timer.dump_trace(os.path.join(
+                self.opt.logger_name, 'snap_trace_%d.json' % niters))
+
     def grad(self, niters):
         model = self.model
         model.train()
@@ -12,6 +12,7 @@ class NUQEstimator(GradientEstimator):
         super(NUQEstimator, self).__init__(*args, **kwargs)
         self.init_data_iter()
         self.qdq = QuantizeMultiBucket(**opt_to_nuq_kwargs(self.opt))
+        self.qdq.timer = self.snap_timer
         self.ngpu = self.opt.nuq_ngpu
         self.acc_grad = None
 
@@ -23,6 +24,10 @@ class NUQEstimator(GradientEstimator):
     def load_state_dict(self, state, model):
         if self.opt.nuq_method == 'none':
             return
+        if state.get('qdq'):
+            # levels and distribution tables saved in the checkpoint
+            self.qdq.load_state_dict(state['qdq'])
+            return
         stats = self.snap_online_mean(model)
         self.qdq.set_mean_variance(stats)
         self.qdq.update_levels()
@@ -33,11 +38,20 @@ class NUQEstimator(GradientEstimator):
         model = model_new
         ig_sm_bkts = self.opt.nuq_ig_sm_bkts
 
+        flat_buffer = getattr(model, 'flat_buffer', None)
         if self.acc_grad is None:
-            self.acc_grad = []
-            with torch.no_grad():
-                for p in model.parameters():
-                    self.acc_grad += [torch.zeros_like(p)]
+            if flat_buffer is not None:
+                # layer views of a single accumulator
+                self.acc_flat = torch.zeros_like(flat_buffer.grad)
+                self.acc_grad = self.unflatten(
+                    self.acc_flat, list(model.parameters()))
+            else:
+                self.acc_grad = []
+                with torch.no_grad():
+                    for p in model.parameters():
+                        self.acc_grad += [torch.zeros_like(p)]
+        if flat_buffer is not None:
+            self.acc_flat.zero_()
         else:
             for a in self.acc_grad:
                 a.zero_()
@@ -46,12 +60,20 @@ class NUQEstimator(GradientEstimator):
             model.zero_grad()
             data = next(self.data_iter)
             loss = model.criterion(model, data)
-            grad = torch.autograd.grad(loss, model.parameters())
-
             per_layer = not self.opt.nuq_layer
+            if flat_buffer is not None:
+                # into the views of the zeroed flat gradient
+                loss.backward()
+                grad = [p.grad for p in model.parameters()]
+            else:
+                grad = torch.autograd.grad(loss, model.parameters())
+
             with torch.no_grad():
                 # quantize network-wide
-                if not per_layer:
+                if not per_layer and flat_buffer is not None:
+                    self.acc_flat += self.qdq.quantize(
+                        flat_buffer.grad, ig_sm_bkts) / self.ngpu
+                elif not per_layer:
                     # flatten the layer globally
                     flatt_grad = self._flatten(grad)
                     # quantize the gradient
@@ -63,9 +85,13 @@ class NUQEstimator(GradientEstimator):
 
                 # quantize layer-wise
                 else:
-                    for g, a in zip(grad, self.acc_grad):
-                        a += self.qdq.quantize(g, ig_sm_bkts) / self.ngpu
+                    for layer, (g, a) in enumerate(zip(grad, self.acc_grad)):
+                        a += self.qdq.quantize(
+                            g, ig_sm_bkts, layer) / self.ngpu
 
+        if in_place and flat_buffer is not None:
+            flat_buffer.grad.copy_(self.acc_flat)
+            return loss
         if in_place:
             for p, a in zip(model.parameters(), self.acc_grad):
                 if p.grad is None:
@@ -5,6 +5,7 @@ import utils
 from data import get_minvar_loader
 from log_utils import LogCollector
 from estim.gvar import MinVarianceGradient
+from estim.dist import call_counts
 
 
 class OptimizerFactory(object):
@@ -26,13 +27,16 @@ class OptimizerFactory(object):
     def reset(self):
         model = self.model
         opt = self.opt
+        params = model.parameters()
+        if opt.flat_buffer:
+            params = [model.flat_buffer.param]
         if opt.optim == 'sgd':
-            optimizer = torch.optim.SGD(model.parameters(),
+            optimizer = torch.optim.SGD(params,
                                         lr=opt.lr, momentum=opt.momentum,
                                         weight_decay=opt.weight_decay,
                                         nesterov=opt.nesterov)
         elif opt.optim == 'adam':
-            optimizer = torch.optim.Adam(model.parameters(),
+            optimizer = torch.optim.Adam(params,
                                          lr=opt.lr,
                                          weight_decay=opt.weight_decay)
         self.optimizer = optimizer
@@ -46,7 +50,11 @@ class OptimizerFactory(object):
         opt = self.opt
         model = self.model
 
-        self.optimizer.zero_grad()
+        if opt.flat_buffer:
+            # zero in place, the gradients are views of the buffer
+            self.optimizer.zero_grad(set_to_none=False)
+        else:
+            self.optimizer.zero_grad()
 
         # Frequent snaps
         inits = list(map(int, opt.g_osnap_iter.split(',')[:-1]))
@@ -56,9 +64,12 @@ class OptimizerFactory(object):
         if ((oitercond or self.niters in inits)
                 and self.niters >= opt.gvar_start):
             print(self.niters)
+            gvar.gest.snap_timer.reset()
+            call_counts.clear()
 
             if opt.g_estim == 'nuq' and opt.nuq_method != 'none':
-                stats = gvar.gest.snap_online_mean(model)
+                with gvar.gest.snap_timer.stage('sample'):
+                    stats = gvar.gest.snap_online_mean(model)
                 if opt.nuq_parallel == 'ngpu':
                     for qdq in gvar.gest.qdq:
                         qdq.set_mean_variance(stats)
@@ -68,12 +79,16 @@ class OptimizerFactory(object):
             isamq = opt.nuq_method == 'amq' or opt.nuq_method == 'amq_nb'
             isalq = opt.nuq_method == 'alq' or opt.nuq_method == 'alq_nb'
             isalqg = opt.nuq_method == 'alqg' or opt.nuq_method == 'alqg_nb'
-            if isamq or isalq or isalqg:
+            isalqdp = (opt.nuq_method == 'alqdp'
+                       or opt.nuq_method == 'alqdp_nb')
+            isalqt = opt.nuq_method == 'alqt' or opt.nuq_method == 'alqt_nb'
+            if isamq or isalq or isalqg or isalqdp or isalqt:
                 if opt.nuq_parallel == 'ngpu':
                     for qdq in gvar.gest.qdq:
                         qdq.update_levels()
                 else:
                     gvar.gest.qdq.update_levels()
+            gvar.log_snap(self.niters)
 
         pg_used = gvar.gest_used
         loss = gvar.grad(self.niters)
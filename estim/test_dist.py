@@ -0,0 +1,94 @@
+import numpy as np
+import torch
+
+from estim.dist import (Distribution, TruncNorm, CondNormalTrunc,
+                        CondNormalTruncHist, EmpiricalHist, QuantileSketch,
+                        SketchHist)
+
+
+def _mixture(seed=0, k=20):
+    rs = np.random.RandomState(seed)
+    return (rs.randn(k) * 0.01, 0.02 + 0.02 * rs.rand(k), 1 + rs.rand(k))
+
+
+def _levels():
+    half = 0.5 ** np.arange(7)[::-1]
+    exp_levels = np.concatenate((-half[::-1], [0], half))
+    dense_levels = np.concatenate(([-1], np.linspace(-0.12, 0.12, 13), [1]))
+    return [exp_levels, dense_levels]
+
+
+def test_quadrature(tol=1e-8):
+    """Gauss-Legendre against scipy quad on the numerically integrated
+    methods of Distribution. TruncNorm and CondNormalTrunc override them
+    with closed forms, so the base class methods are called directly.
+    """
+    means, sigmas, norms = _mixture()
+    for dist in (TruncNorm(0.001, 0.03),
+                 CondNormalTrunc(means, sigmas, norms)):
+        for levels in _levels():
+            c, d = levels[:-1], levels[1:]
+            results = {}
+            for quadrature in ('gauss', 'adaptive'):
+                dist.quadrature = quadrature
+                results[quadrature] = (
+                    Distribution.est_var_adjacent_levels(dist, c, d),
+                    Distribution.est_var_pgd_adj_levels(
+                        dist, c[:-1], d[:-1], d[1:]),
+                    # the ppf is flat in the tails, compare its argument
+                    dist.cdf(Distribution.estimate_variance_adj_inv(
+                        dist, c, d)))
+            for name, gauss, adaptive in zip(
+                    ('adjacent', 'pgd', 'adj_inv'),
+                    results['gauss'], results['adaptive']):
+                error = np.abs(gauss - adaptive).max() / np.abs(
+                    adaptive).max()
+                print(type(dist).__name__, name, 'relative error', error)
+                assert error < tol, name
+
+
+def test_quantile_bins(nbins=2500, tol=1e-4):
+    """Variance on quantile bins against a 50k-bin linear table"""
+    means, sigmas, norms = _mixture()
+    reference = CondNormalTruncHist(means, sigmas, norms, nbins=50000)
+    for levels in _levels():
+        var = reference.estimate_variance(levels)
+        errors = {}
+        for bin_type in ('quantile', 'linear'):
+            dist = CondNormalTruncHist(means, sigmas, norms, nbins=nbins,
+                                       bin_type=bin_type)
+            errors[bin_type] = abs(dist.estimate_variance(levels) - var) / var
+            print(bin_type, nbins, 'relative error', errors[bin_type])
+        assert errors['quantile'] < tol
+        assert errors['quantile'] < errors['linear']
+
+
+def test_sketch_hist(size=2048, tol=0.02):
+    """Variance on the bins of a QuantileSketch against a 200k-bin
+    histogram of the same samples
+    """
+    means, sigmas, _ = _mixture()
+    rs = np.random.RandomState(0)
+    np.random.seed(0)
+    component = rs.randint(len(means), size=1000000)
+    x = means[component] + sigmas[component] * rs.randn(len(component))
+    sketch = QuantileSketch(size)
+    for chunk in np.array_split(x, 10):
+        sketch.update(torch.from_numpy(chunk))
+    reference = EmpiricalHist(np.histogram(x, 200000, (-1, 1))[0])
+    dist = SketchHist(sketch)
+    # no mass outside of the range of the sketch
+    values, _ = sketch.items()
+    print('cdf at the ends of the sketch', dist.cdf(values[[0, -1]]))
+    assert dist.cdf(values[0]) == 0 and dist.cdf(values[-1]) == 1
+    levels = _levels()[0]
+    var = reference.estimate_variance(levels)
+    error = abs(dist.estimate_variance(levels) - var) / var
+    print('sketch', size, 'relative error', error)
+    assert error < tol
+
+
+if __name__ == '__main__':
+    test_quadrature()
+    test_quantile_bins()
+    test_sketch_hist()
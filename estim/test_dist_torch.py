@@ -0,0 +1,74 @@
+import numpy as np
+import torch
+
+from estim.dist import TruncNorm, CondNormalTruncHist
+from estim.dist_torch import to_torch
+from nuq.quantize import alq_adam
+
+
+def _dists(nbins=10000):
+    rs = np.random.RandomState(0)
+    means, sigmas, norms = (rs.randn(20) * 0.01, 0.02 + 0.02 * rs.rand(20),
+                            1 + rs.rand(20))
+    return [TruncNorm(0.001, 0.03, nbins=nbins),
+            CondNormalTruncHist(means, sigmas, norms, nbins=nbins)]
+
+
+def _levels():
+    half = 0.5 ** np.arange(4)[::-1]
+    return np.stack((np.linspace(-1, 1, 9),
+                     np.concatenate((-half[::-1], [0], half))))
+
+
+def _error(x, y):
+    y = np.asarray(y)
+    return np.abs(np.asarray(x) - y).max() / np.abs(y).max()
+
+
+def test_parity(tol=1e-10):
+    """The torch distributions against the NumPy ones they are copied from,
+    and the NumPy copies back.
+    """
+    x = np.linspace(-1, 1, 1001)
+    for dist in _dists():
+        torch_dist = to_torch(dist)
+        # the torch histogram ppf returns begin below the first bin, the
+        # NumPy one wraps around to the last bin there
+        first = getattr(dist, 'cdf_bin_sum', [0])[0]
+        p = np.linspace(max(first, 0.01), 0.99, 999)
+        errors = {
+            'cdf': _error(torch_dist.cdf(x).numpy(), dist.cdf(x)),
+            'pdf': _error(torch_dist.pdf(x).numpy(), dist.pdf(x)),
+            'ppf': _error(torch_dist.ppf(p).numpy(), dist.ppf(p)),
+            'variance': _error(
+                torch_dist.estimate_variance_batch(_levels()).numpy(),
+                dist.estimate_variance_batch(_levels())),
+            'to_numpy': _error(torch_dist.to_numpy().cdf(x), dist.cdf(x))}
+        for index, (table, torch_table) in enumerate(zip(
+                dist.moment_tables(), torch_dist.moment_tables())):
+            errors['m%d' % index] = _error(torch_table.numpy(), table)
+        for name, error in errors.items():
+            print(type(dist).__name__, name, 'relative error', error)
+            assert error < tol, name
+
+
+def test_alq_adam(tol=1e-8):
+    """Joint level optimizer on the NumPy and on the torch tables"""
+    device = 'cuda' if torch.cuda.is_available() else 'cpu'
+    dists = _dists()
+    initial_levels = list(_levels()) * len(dists)
+    grad_dists = [dist for dist in dists for _ in _levels()]
+    levels, losses = alq_adam(initial_levels, grad_dists, 200,
+                              device=device)
+    torch_levels, torch_losses = alq_adam(
+        initial_levels, [to_torch(dist, device) for dist in grad_dists],
+        200, device=device)
+    error = _error(torch_levels.cpu().numpy(), levels)
+    print('alq_adam levels relative error', error)
+    print('alq_adam losses', losses, torch_losses.cpu().numpy())
+    assert error < tol
+
+
+if __name__ == '__main__':
+    test_parity()
+    test_alq_adam()
@@ -1,4 +1,6 @@
 from collections import OrderedDict, defaultdict
+from contextlib import contextmanager
+import json
 import numpy as np
 from tensorboardX import SummaryWriter
 import time
@@ -143,6 +145,7 @@ class LogCollector(object):
         self.meters[k].update(v, n)
 
     def __str__(self):
+        self._read_events()
         s = ''
         for i, (k, v) in enumerate(self.meters.items()):
             if k in self.log_keys or 'all' in self.log_keys:
@@ -184,9 +187,88 @@ class Profiler(object):
         self.start()
 
     def __str__(self):
+        self._read_events()
         s = ''
         for i, (k, v) in enumerate(self.meters.items()):
             if i > 0:
                 s += '  '
             s += k+': ' + str(v)
         return s
+
+
+class StageTimer(object):
+    """Wall-clock time of named stages. With sync every stage waits for its
+    kernels and is measured with perf_counter, otherwise stages on a CUDA
+    device are measured with events that are read once, when the times are
+    logged, so the stages do not add host syncs.
+
+    Parameters:
+        sync (bool): synchronize the device at the end of every stage
+    """
+
+    def __init__(self, sync=False):
+        self.sync = sync
+        self.reset()
+
+    def reset(self):
+        self.times = OrderedDict()
+        self.events = []
+        self.pending = []
+
+    @contextmanager
+    def stage(self, name):
+        use_events = not self.sync and torch.cuda.is_available()
+        if use_events:
+            start_event = torch.cuda.Event(enable_timing=True)
+            start_event.record()
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            if use_events:
+                end_event = torch.cuda.Event(enable_timing=True)
+                end_event.record()
+                self.pending += [(name, start_event, end_event)]
+            else:
+                if self.sync and torch.cuda.is_available():
+                    # wait for the asynchronous kernels of this stage
+                    torch.cuda.synchronize()
+                end = time.perf_counter()
+                self.times[name] = self.times.get(name, 0) + end - start
+                self.events += [(name, start, end)]
+
+    def _read_events(self):
+        """Times of the stages measured with events, a single host sync"""
+        if len(self.pending) == 0:
+            return
+        torch.cuda.synchronize()
+        origin = self.pending[0][1]
+        for name, start_event, end_event in self.pending:
+            start = origin.elapsed_time(start_event) / 1000
+            duration = start_event.elapsed_time(end_event) / 1000
+            self.times[name] = self.times.get(name, 0) + duration
+            self.events += [(name, start, start + duration)]
+        self.pending = []
+
+    def __str__(self):
+        self._read_events()
+        s = ''
+        for i, (k, v) in enumerate(self.times.items()):
+            if i > 0:
+                s += '  '
+            s += '%s: %.4f' % (k, v)
+        return s
+
+    def tb_log(self, tb_logger, prefix='', step=None):
+        self._read_events()
+        for k, v in self.times.items():
+            tb_logger.log_value(prefix+k, v, step=step)
+
+    def dump_trace(self, filename):
+        """Write the stages in the Chrome trace event format"""
+        self._read_events()
+        events = [{'name': name, 'ph': 'X', 'pid': 0, 'tid': 0,
+                   'ts': start*1e6, 'dur': (end-start)*1e6}
+                  for name, start, end in self.events]
+        with open(filename, 'w') as f:
+            json.dump({'traceEvents': events}, f)
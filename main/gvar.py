@@ -174,7 +174,12 @@ def main():
         model_path = os.path.join(opt.logger_name, opt.ckpt_name)
         if os.path.isfile(model_path):
             print("=> loading checkpoint '{}'".format(model_path))
-            checkpoint = torch.load(model_path)
+            try:
+                # memory-map the tensors, e.g. the distribution tables
+                checkpoint = torch.load(model_path, mmap=True)
+            except (TypeError, RuntimeError):
+                # torch<2.1 or a checkpoint in the legacy format
+                checkpoint = torch.load(model_path)
             best_prec1 = checkpoint['best_prec1']
             optimizer.niters = checkpoint['niters']
             epoch = checkpoint['epoch']
@@ -1,5 +1,6 @@
 import torch
 import torch.nn
+import utils
 import models.mnist
 import models.cifar10
 import models.logreg
@@ -48,5 +49,8 @@ def init_model(opt):
     model.criterion = models.loss.nll_loss
     if opt.cuda:
         model.cuda()
+    if opt.flat_buffer:
+        # after .cuda(), which replaces the parameter tensors
+        model.flat_buffer = utils.FlatBuffer(model)
 
     return model
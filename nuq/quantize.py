@@ -2,7 +2,13 @@ import numpy as np
 import torch
 from cuquant import QDQ
 import math
-from estim.dist import TruncNorm, CondNormalTruncHist
+import logging
+from collections import OrderedDict
+from scipy.stats import truncnorm
+from estim.dist import (TruncNorm, CondNormalTruncHist, HistDistribution,
+                        EmpiricalHist, SketchHist)
+from estim.dist_torch import TorchTruncNorm, TorchCondNormalTruncHist
+from log_utils import StageTimer
 
 EPS = 1e-7
 
@@ -11,7 +17,13 @@ def get_quantile_levels(bits, grad_dist):
     """quantile levels """
     num_levels = 2 << bits - 1
     cdf_points = np.linspace(0, 1, num=num_levels)
-    levels = [grad_dist.ppf(level) for level in cdf_points]
+    levels = grad_dist.ppf(cdf_points)
+    if isinstance(levels, torch.Tensor):
+        # torch distributions keep the levels on their device
+        levels[0] = grad_dist.begin
+        levels[-1] = grad_dist.end
+        return levels
+    levels = list(levels)
 
     levels[0] = grad_dist.begin
     levels[-1] = grad_dist.end
@@ -132,6 +144,38 @@ def bisection(begin, end, f):
     return bisection(begin, x, f)
 
 
+def amq_norm_based_gradient(mul, grad_dist, bits):
+    """Derivative of the norm-based AMQ variance w.r.t. the multiplier
+
+    Parameters:
+        mul (float): the multiplier
+        grad_dist (dist.Distribution): is the distribution
+        bits (int): number of bits
+    """
+    s = 2 ** (bits - 1) - 1
+    j = np.arange(s)
+    # one row per mixture component
+    means = np.asarray(grad_dist.means)[:, np.newaxis]
+    sigmas = np.asarray(grad_dist.sigmas)[:, np.newaxis]
+    a = np.asarray(grad_dist.a)[:, np.newaxis]
+    b = np.asarray(grad_dist.b)[:, np.newaxis]
+    powers = mul ** np.arange(s + 1)
+
+    # from eq G.3 in Appendix
+    arg1_1 = means * (j * mul ** (j - 1) + (j + 1) * mul ** j) \
+        - (2 * j + 1) * mul ** (2 * j)
+    cdfs = truncnorm.cdf(powers, a, b, loc=means, scale=sigmas)
+    arg1 = np.sum(arg1_1 * (cdfs[:, :-1] - cdfs[:, 1:]), axis=1)
+
+    arg2_1 = j * mul ** (j - 1) + (j + 1) * mul ** j
+    pdfs = truncnorm.pdf(powers, a, b, loc=means, scale=sigmas)
+    arg2 = np.sum(arg2_1 * (pdfs[:, 1:] - pdfs[:, :-1]), axis=1)
+    sum = np.sum(grad_dist.coeff * (arg1 + sigmas[:, 0] ** 2 * arg2))
+
+    cdf_s, cdf_0 = grad_dist.cdf(np.array([mul ** s, 0.0]))
+    return 2 * s * (mul ** (2 * s - 1)) * (cdf_s - cdf_0) + sum
+
+
 def amq_norm_based(initial_point, grad_dist, bits, lr=0.1, epochs=50):
     """AMQ Norm-based implementation
 
@@ -144,44 +188,42 @@ def amq_norm_based(initial_point, grad_dist, bits, lr=0.1, epochs=50):
     """
 
     mul = initial_point
-    s = 2 ** (bits - 1) - 1
     all_mul = []
-    iter = 0
     for epoch in range(epochs):
-        sum = 0.0
-        for norm, mean, sigma, coeff in zip(
-                grad_dist.norms,
-                grad_dist.means,
-                grad_dist.sigmas,
-                grad_dist.coeff):
-
-            dist_comp = TruncNorm(
-                mean, sigma, grad_dist.begin, grad_dist.end, grad_dist.nbins)
-
-            # from eq G.3 in Appendix
-            def arg1_1(j):
-                return mean * (j * mul ** (j - 1) + (j + 1) * mul ** j) \
-                    - (2 * j + 1) * mul ** (2 * j)
-            arg1 = np.sum(np.asarray(
-                [arg1_1(j)*(dist_comp.cdf(mul**j) - dist_comp.cdf(mul**(j+1)))
-                    for j in range(0, s)]))
-
-            def arg2_1(j):
-                return j * mul ** (j - 1) + (j + 1) * mul ** j
-            arg2 = np.sum(np.asarray(
-                [arg2_1(j) * (dist_comp.pdf(mul ** (j + 1))
-                              - dist_comp.pdf(mul ** (j)))
-                    for j in range(0, s)]))
-            sum += coeff * (arg1 + sigma ** 2 * arg2)
-
-        gradient = 2 * s * (mul ** (2 * s - 1)) * \
-            (grad_dist.cdf(mul ** s) - grad_dist.cdf(0)) + sum
+        gradient = amq_norm_based_gradient(mul, grad_dist, bits)
         mul = mul - lr * gradient
-        iter += 1
         all_mul.append(mul)
     return mul, all_mul
 
 
+def amq_norm_less_gradient(mul, grad_dist, bits):
+    """Derivative of the norm-less AMQ variance w.r.t. the multiplier
+
+    Parameters:
+        mul (float): the multiplier
+        grad_dist (dist.Distribution): is the distribution
+        bits (int): number of bits
+    """
+    s = 2 ** (bits - 1) - 1
+    j = np.arange(s)
+    mean = grad_dist.mean
+    sigma = grad_dist.sigma
+    powers = mul ** np.arange(s + 1)
+
+    arg1_1 = mean * (j * mul ** (j - 1) + (j + 1) * mul ** j) \
+        - (2 * j + 1) * mul ** (2 * j)
+    cdfs = grad_dist.cdf(powers)
+    arg1 = np.sum(arg1_1 * (cdfs[:-1] - cdfs[1:]))
+
+    arg2_1 = j * mul ** (j - 1) + (j + 1) * mul ** j
+    pdfs = grad_dist.pdf(powers)
+    arg2 = np.sum(arg2_1 * (pdfs[1:] - pdfs[:-1]))
+
+    cdf_s, cdf_0 = grad_dist.cdf(np.array([mul ** s, 0.0]))
+    return 2 * s * (mul ** (2 * s - 1)) * (cdf_s - cdf_0) \
+        + arg1 + sigma ** 2 * arg2
+
+
 def amq_norm_less(initial_point, grad_dist, bits, lr=0.1, epochs=200):
     """AMQ Norm-less implementation
 
@@ -194,33 +236,68 @@ def amq_norm_less(initial_point, grad_dist, bits, lr=0.1, epochs=200):
     """
 
     mul = initial_point
-    s = 2 ** (bits - 1) - 1
-    mean = grad_dist.mean
-    sigma = grad_dist.sigma
     all_mul = []
     for epoch in range(epochs):
+        gradient = amq_norm_less_gradient(mul, grad_dist, bits)
+        mul = mul - lr * gradient
+        all_mul.append(mul)
 
-        def arg1_1(j):
-            return mean * (j * mul ** (j - 1) + (j + 1) * mul ** j) \
-                - (2 * j + 1) * mul ** (2 * j)
-        arg1 = np.sum(np.asarray([arg1_1(j) * (
-            grad_dist.cdf(mul ** j) -
-            grad_dist.cdf(mul ** (j+1))) for j in range(0, s)]))
+    return mul, all_mul
 
-        def arg2_1(j):
-            return j * mul ** (j - 1) + (j + 1) * mul ** j
-        arg2 = np.sum(np.asarray([
-            arg2_1(j) * (grad_dist.pdf(mul ** (j + 1)) -
-                         grad_dist.pdf(mul ** (j))) for j in range(0, s)]))
 
-        gradient = 2 * s * (mul ** (2 * s - 1)) * \
-            (grad_dist.cdf(mul ** s) - grad_dist.cdf(0)) \
-            + arg1 + sigma ** 2 * arg2
+def amq_secant(gradient_f, begin=0.01, end=0.99, nscan=11, tol=1e-6,
+               niters=30):
+    """Find the minima of a 1-D function from its derivative.
 
-        mul = mul - lr * gradient
-        all_mul.append(mul)
+    The derivative is scanned once on `nscan` points of [begin, end]. Every
+    sign change from negative to positive brackets a minimum that is refined
+    with secant steps (finite difference curvature of the derivative),
+    falling back to bisection whenever a step leaves the bracket or does
+    not shrink it enough.
 
-    return mul, all_mul
+    Parameters:
+        gradient_f (function): derivative of the objective
+        begin (float): beginning of the interval
+        end (float): end of the interval
+        nscan (int): number of scan points
+        tol (float): tolerance on the derivative and the bracket width
+        niters (int): maximum number of refinement steps per bracket
+    Returns: the candidate minima and the number of derivative evaluations
+    """
+    xs = np.linspace(begin, end, nscan)
+    gs = [gradient_f(x) for x in xs]
+    nevals = nscan
+
+    minima = []
+    # boundary minima when the derivative does not change sign there
+    if gs[0] > 0:
+        minima.append(xs[0])
+    if gs[-1] < 0:
+        minima.append(xs[-1])
+    for i in range(nscan - 1):
+        if not (gs[i] < 0 and gs[i + 1] >= 0):
+            continue
+        a, b = xs[i], xs[i + 1]
+        x0, g0, x1, g1 = a, gs[i], b, gs[i + 1]
+        width = np.inf
+        for _ in range(niters):
+            if abs(g1) < tol or b - a < tol:
+                break
+            x = x1 - g1 * (x1 - x0) / (g1 - g0) if g1 != g0 else a
+            if not a < x < b or b - a > width / 2:
+                # the secant step left the bracket or the last step did
+                # not halve it
+                x = (a + b) / 2
+            width = b - a
+            g = gradient_f(x)
+            nevals += 1
+            if g < 0:
+                a = x
+            else:
+                b = x
+            x0, g0, x1, g1 = x1, g1, x, g
+        minima.append(x1 if abs(g1) < tol else (a + b) / 2)
+    return minima, nevals
 
 
 def alq(initial_levels, grad_dist, epochs, inv=False, sym=True):
@@ -281,6 +358,257 @@ def alq(initial_levels, grad_dist, epochs, inv=False, sym=True):
     return new_levels, all_levels, losses
 
 
+def alq_dp(grad_dist, bits, nbins=1000, sym=True):
+    """Variance-optimal levels by dynamic programming.
+
+    Levels are restricted to a grid of about `nbins` intervals over the
+    support, half uniform and half placed at equal-mass quantiles. Interval
+    costs come from the cumulative moment tables of the
+    distribution and the monotone argmin of the cost matrix is exploited
+    by divide and conquer, so every level costs O(nbins log nbins).
+    Symmetric levels +-l_1, ..., +-l_k are solved on the density folded
+    onto [0, end], where the middle interval [-l_1, l_1] costs
+    int_0^l_1 (l_1^2 - x^2) (f(x) + f(-x)) dx.
+
+    Parameters:
+        grad_dist (dist.Distribution): is the distribution
+        bits (int): number of bits
+        nbins (int): number of grid intervals
+        sym (bool): use symmetric levels
+    """
+    num_levels = 2 << bits - 1
+    end = grad_dist.end
+    if sym:
+        # positive levels, the first one is chosen with the middle interval
+        begin = 0
+        first = 1
+        num_intervals = num_levels // 2 - 1
+        edges = np.abs(grad_dist.bin_edges)
+        edges = np.unique(edges[edges <= end])
+        mass = (grad_dist.partial_moments(edges)[0]
+                - grad_dist.partial_moments(-edges)[0])
+    else:
+        begin = grad_dist.begin
+        first = 0
+        num_intervals = num_levels - 1
+        edges = grad_dist.bin_edges
+        mass = grad_dist.moment_tables()[0]
+    # half of the grid is uniform, the other half has equal mass per cell
+    equal_mass = np.interp(
+        np.linspace(mass[0], mass[-1], nbins // 2 + 1), mass, edges)
+    grid = np.unique(np.concatenate((
+        np.linspace(begin, end, nbins - nbins // 2 + 1),
+        np.clip(equal_mass, begin, end))))
+    nbins = len(grid) - 1
+    assert nbins >= num_intervals + first, "Grid is coarser than the levels"
+    m0, m1, m2 = grad_dist.partial_moments(grid)
+    if sym:
+        # moments of the folded density f(x) + f(-x) on [0, x]
+        n0, n1, n2 = grad_dist.partial_moments(-grid)
+        z0, z1, z2 = grad_dist.partial_moments(0.)
+        m0 = (m0 - z0) + (z0 - n0)
+        m1 = (m1 - z1) - (z1 - n1)
+        m2 = (m2 - z2) + (z2 - n2)
+
+    def cost(left, right):
+        # int_c^d (x - c) (d - x) f(x) dx
+        c = grid[left]
+        d = grid[right]
+        return (-c * d * (m0[right] - m0[left])
+                + (c + d) * (m1[right] - m1[left])
+                - (m2[right] - m2[left]))
+
+    if sym:
+        # middle interval [-l_1, l_1], l_1 > 0
+        prev = grid ** 2 * m0 - m2
+        prev[0] = np.inf
+    else:
+        prev = np.full(nbins + 1, np.inf)
+        prev[0] = 0
+    argmins = np.zeros((num_intervals, nbins + 1), dtype=int)
+    for t in range(num_intervals):
+        curr = np.full(nbins + 1, np.inf)
+        # (lo, hi, opt_lo, opt_hi): argmin of columns lo..hi is known to
+        # lie in opt_lo..opt_hi
+        stack = [(t + first + 1, nbins, t + first, nbins - 1)]
+        while stack:
+            lo, hi, opt_lo, opt_hi = stack.pop()
+            if lo > hi:
+                continue
+            mid = (lo + hi) // 2
+            cand = np.arange(opt_lo, min(mid - 1, opt_hi) + 1)
+            total = prev[cand] + cost(cand, mid)
+            best = int(np.argmin(total))
+            curr[mid] = total[best]
+            argmins[t, mid] = cand[best]
+            stack.append((lo, mid - 1, opt_lo, cand[best]))
+            stack.append((mid + 1, hi, cand[best], opt_hi))
+        prev = curr
+
+    index = [nbins]
+    for t in reversed(range(num_intervals)):
+        index.append(argmins[t, index[-1]])
+    new_levels = list(grid[index[::-1]])
+
+    if sym:
+        negative_levels = [-level for level in new_levels]
+        negative_levels.reverse()
+        new_levels = negative_levels + new_levels
+    return new_levels
+
+
+def _torch_variance(levels, edges, m0, m1, m2):
+    """Differentiable variance of every row of `levels` from the moment
+    tables of the distribution at the same row.
+    """
+    x = torch.max(torch.min(levels, edges[:, -1:]), edges[:, :1])
+    index = torch.searchsorted(edges, x.detach().contiguous(), right=True) - 1
+    index = index.clamp(0, edges.shape[1] - 2)
+    left = edges.gather(1, index)
+    width = edges.gather(1, index + 1) - left
+    density = (m0.gather(1, index + 1) - m0.gather(1, index)) / width
+    p0 = m0.gather(1, index) + density * (x - left)
+    p1 = m1.gather(1, index) + density * (x ** 2 - left ** 2) / 2
+    p2 = m2.gather(1, index) + density * (x ** 3 - left ** 3) / 3
+    c = levels[:, :-1]
+    d = levels[:, 1:]
+    var = (-c * d * (p0[:, 1:] - p0[:, :-1])
+           + (c + d) * (p1[:, 1:] - p1[:, :-1])
+           - (p2[:, 1:] - p2[:, :-1]))
+    return var.sum(dim=1)
+
+
+def alq_adam(initial_levels, grad_dists, epochs, lr=1e-3, sym=True,
+             device='cpu'):
+    """ALQ with all levels optimized jointly by projected Adam.
+
+    Every row of `initial_levels` is an independent problem paired with the
+    distribution at the same index of `grad_dists`. All rows are solved
+    together as batched tensor operations on `device`.
+
+    Parameters:
+        initial_levels (np.ndarray): (batch x levels) initial levels
+        grad_dists (list): distributions with the same number of bins
+        epochs (int): number of Adam steps
+        lr (float): learning rate
+        sym (bool): use symmetric levels
+        device (torch.device): device to run the solver on
+    """
+    # torch distributions (estim.dist_torch) keep everything on the device
+    on_device = isinstance(grad_dists[0].bin_edges, torch.Tensor)
+    if on_device:
+        levels = torch.stack([
+            torch.as_tensor(row, dtype=torch.float64, device=device)
+            for row in initial_levels])
+        tables = torch.stack([
+            torch.stack([d.bin_edges] + list(d.moment_tables()))
+            for d in grad_dists])
+    else:
+        levels = torch.as_tensor(np.asarray(
+            initial_levels, dtype=np.float64), device=device)
+        tables = np.stack([np.stack([d.bin_edges] + list(d.moment_tables()))
+                           for d in grad_dists])
+    if sym:
+        # Assuming last level is 1, setting first dummy level to 0
+        levels = torch.cat((levels.new_zeros(len(levels), 1),
+                            levels[:, levels.shape[1] // 2:]), dim=1)
+    edges, m0, m1, m2 = torch.as_tensor(
+        tables, dtype=torch.float64, device=device).unbind(1)
+    edges = edges.contiguous()
+
+    first = levels[:, :1]
+    last = levels[:, -1:]
+    inner = levels[:, 1:-1].clone().requires_grad_()
+    optimizer = torch.optim.Adam([inner], lr=lr)
+    for epoch in range(epochs):
+        optimizer.zero_grad()
+        losses = _torch_variance(
+            torch.cat((first, inner, last), dim=1), edges, m0, m1, m2)
+        losses.sum().backward()
+        optimizer.step()
+        with torch.no_grad():
+            # project back to ordered levels between the end points
+            inner.copy_(torch.sort(inner, dim=1)[0])
+            inner.copy_(torch.max(torch.min(inner, last), first))
+
+    with torch.no_grad():
+        new_levels = torch.cat((first, inner, last), dim=1)
+        if sym:
+            # dropping dummy level at 0
+            new_levels = new_levels[:, 1:]
+            new_levels = torch.cat(
+                (-new_levels.flip(1), new_levels), dim=1)
+        losses = _torch_variance(new_levels, edges, m0, m1, m2)
+    if on_device:
+        return new_levels, losses
+    return new_levels.cpu().numpy(), losses.cpu().numpy()
+
+
+class LevelsCache(object):
+    """Bounded LRU cache of solved levels.
+
+    Entries are keyed by a quantized signature of the gradient distribution
+    (mean, sigma and the mass of equal-width chunks of the interval)
+    together with the method and the number of bits. Two distributions
+    whose signatures fall in the same cell of size `tol` share the same
+    levels.
+    """
+
+    def __init__(self, size, tol=1e-3, sketch_bins=16):
+        self.size = size
+        self.tol = tol
+        self.sketch_bins = sketch_bins
+        self.entries = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+
+    def signature(self, method, bits, grad_dist_nl, grad_dist_nb):
+        # mass of equal-width chunks of [begin, end], independent of where
+        # the bins of the distribution are
+        points = np.linspace(grad_dist_nb.begin, grad_dist_nb.end,
+                             self.sketch_bins + 1)
+        sketch = np.diff(grad_dist_nb.cdf(points))
+        values = np.concatenate(
+            ([grad_dist_nl.mean, grad_dist_nl.sigma], sketch))
+        cells = np.round(values / self.tol).astype(int)
+        return (method, bits) + tuple(cells.tolist())
+
+    def get(self, key):
+        if key not in self.entries:
+            self.misses += 1
+            return None
+        self.hits += 1
+        self.entries.move_to_end(key)
+        return self.entries[key]
+
+    def put(self, key, levels, multiplier):
+        # tensors and floats so that checkpoints load with weights_only
+        self.entries[key] = (
+            torch.as_tensor(np.asarray(levels, dtype=np.float64)),
+            float(multiplier))
+        self.entries.move_to_end(key)
+        while len(self.entries) > self.size:
+            self.entries.popitem(last=False)
+
+    def hit_rate(self):
+        total = self.hits + self.misses
+        return self.hits / total if total > 0 else 0.0
+
+    def state_dict(self):
+        return {
+            'entries': list(self.entries.items()),
+            'hits': self.hits,
+            'misses': self.misses
+        }
+
+    def load_state_dict(self, state):
+        self.entries = OrderedDict(state['entries'])
+        while len(self.entries) > self.size:
+            self.entries.popitem(last=False)
+        self.hits = state['hits']
+        self.misses = state['misses']
+
+
 class QuantizeMultiBucket(object):
     def __init__(self, method, bits, bucket_size, multiplier, **kwargs):
         """QSGD: qdqL2 + levels_uni
@@ -318,6 +646,18 @@ class QuantizeMultiBucket(object):
         elif method == 'alqg_nb':
             self.levels = get_exp_levels(bits, multiplier)
             self.norm_type = 'fro'
+        elif method == 'alqdp':
+            self.levels = get_exp_levels(bits, multiplier)
+            self.norm_type = 'fro'
+        elif method == 'alqt':
+            self.levels = get_exp_levels(bits, multiplier)
+            self.norm_type = 'fro'
+        elif method == 'alqt_nb':
+            self.levels = get_exp_levels(bits, multiplier)
+            self.norm_type = 'fro'
+        elif method == 'alqdp_nb':
+            self.levels = get_exp_levels(bits, multiplier)
+            self.norm_type = 'fro'
         elif method == 'trn':
             self.levels = get_ternary_levels()
             self.norm_type = float('inf')
@@ -334,37 +674,242 @@ class QuantizeMultiBucket(object):
         self.path = kwargs['path']
         self.amq_lr = kwargs['amq_lr']
         self.amq_epochs = kwargs['amq_epochs']
+        self.amq_solver = kwargs['amq_solver']
+        self.amq_evals = None
+        # per layer-group levels used by layer-wise quantization
+        self.layer_groups = None
+        self.group_dists = None
+        self.group_levels = None
+        self.group_qdq = None
+        self.timer = StageTimer()
         self.symmetric = kwargs['symmetric']
         self.clipping = kwargs['clipping']
         self.inv = kwargs['inv']
+        self.dp_bins = kwargs['dp_bins']
+        self.adam_lr = kwargs['adam_lr']
+        self.adam_epochs = kwargs['adam_epochs']
+        self.dist = kwargs['dist']
+        self.ema_weight = kwargs['ema_weight']
+        self.dist_backend = kwargs['dist_backend']
+        self.error_int = kwargs['error_int']
+        self.nbins = kwargs['nbins']
+        self.bin_type = kwargs['bin_type']
+        self.quad_order = kwargs['quad_order']
+        assert not (self.dist != 'normal' and method == 'amq_nb'), \
+            'amq_nb needs the norm-based mixture, use --nuq_dist normal'
+        assert self.dist_backend == 'numpy' or (
+            self.dist == 'normal' and self.bin_type == 'linear'
+            and method in ('alqt', 'alqt_nb')
+            and kwargs['cache_size'] == 0 and not self.error_int), \
+            'the torch distributions support the normal distribution with ' \
+            'linear bins and the alqt methods without the levels cache ' \
+            'and the integrated error'
+        assert not kwargs['level_groups'] or method in ('alqt', 'alqt_nb'), \
+            'the levels of the layer groups are solved in one batch by the ' \
+            'joint level optimizer, use --nuq_method alqt or alqt_nb'
+        assert not (kwargs['level_groups'] and kwargs['network_wide']), \
+            'the levels of the layer groups need layer-wise quantization, ' \
+            'drop --nuq_layer or --nuq_level_groups'
         self.levels = torch.as_tensor(self.levels, dtype=torch.float32).cuda()
         self.qdq = QDQ(self.levels)
         self.mean_weights = 0
         self.variance_weights = 0.1
         self.error = None
+        self.grad_dist_nb = None
+        self.grad_dist_nl = None
+        self.level_jitter = None
+        self.levels_cache = None
+        if kwargs['cache_size'] > 0:
+            self.levels_cache = LevelsCache(
+                kwargs['cache_size'], kwargs['cache_tol'])
 
     def set_mean_variance(self, stats):
-        self.mean = mean = stats['nl']['mean']
-        self.variance = stats['nl']['sigma'] ** 2
-        self.norms = norms = stats['nb']
+        mean = stats['nl']['mean']
+        variance = stats['nl']['sigma'] ** 2
+        # exponential moving average with the previous snapshots
+        ema = self.ema_weight
+        previous_nb = self.grad_dist_nb if ema < 1 else None
+        previous_groups = self.group_dists if ema < 1 else None
+        if previous_nb is not None:
+            second = (ema * (variance + mean ** 2)
+                      + (1 - ema) * (self.variance + self.mean ** 2))
+            mean = ema * mean + (1 - ema) * self.mean
+            variance = second - mean ** 2
+        self.mean = mean
+        self.variance = variance
+        self.norms = stats['nb']
 
         interval = self.interval
-        sigma = torch.sqrt(torch.tensor(self.variance)).cpu().item()
-        self.grad_dist_nb = CondNormalTruncHist(
-            norms['means'], norms['sigmas'], norms['norms'], -interval,
-            interval, nbins=50000, bin_type='linear')
-        self.grad_dist_nl = TruncNorm(
-            mean, sigma, -interval, interval, nbins=50000, bin_type='linear')
-
-        self.error = self.grad_dist_nb.estimate_variance(self.levels.cpu())
+        sigma = torch.sqrt(torch.as_tensor(self.variance))
+        if self.dist_backend == 'numpy':
+            sigma = sigma.cpu().item()
+        with self.timer.stage('dist'):
+            self.grad_dist_nb = self._norm_based_dist(stats, interval)
+            if previous_nb is not None:
+                self.grad_dist_nb.blend(previous_nb, ema)
+            self.grad_dist_nl = self._norm_less_dist(mean, sigma, interval)
+
+        with self.timer.stage('error'):
+            if self.dist_backend == 'torch':
+                self.error = self.grad_dist_nb.estimate_variance_batch(
+                    self.levels[None])[0]
+            elif self.error_int:
+                self.error = float(self.grad_dist_nb.estimate_variance_int(
+                    self.levels.cpu().numpy()))
+            else:
+                self.error = float(self.grad_dist_nb.estimate_variance_batch(
+                    [self.levels.cpu().numpy()])[0])
+
+        if 'groups' in stats:
+            self.layer_groups = stats['layer_groups']
+            self.group_dists = []
+            with self.timer.stage('group_dist'):
+                self._set_group_dists(stats['groups'], interval)
+                if (previous_groups is not None
+                        and len(previous_groups) == len(self.group_dists)):
+                    self._blend_group_dists(previous_groups, ema)
+
+    def _norm_based_dist(self, stats, interval):
+        """Distribution of the normalized coordinates, either the empirical
+        histogram or the mixture of the bucket statistics
+        """
+        norms = stats['nb']
+        if self.dist_backend == 'torch':
+            return TorchCondNormalTruncHist(
+                norms['means'], norms['sigmas'], norms['norms'], -interval,
+                interval, nbins=self.nbins, device=self.levels.device)
+        if self.dist == 'hist':
+            dist = EmpiricalHist(stats['hist'], -interval, interval)
+        elif self.dist == 'sketch':
+            dist = SketchHist(stats['sketch'], -interval, interval,
+                              nbins=self.nbins)
+        else:
+            dist = CondNormalTruncHist(
+                norms['means'], norms['sigmas'], norms['norms'], -interval,
+                interval, nbins=self.nbins, bin_type=self.bin_type)
+        # on the instance, other quantizers keep their own order
+        dist.quad_order = self.quad_order
+        return dist
+
+    def _norm_less_dist(self, mean, sigma, interval):
+        if self.dist_backend == 'torch':
+            return TorchTruncNorm(mean, sigma, -interval, interval,
+                                  nbins=self.nbins, device=self.levels.device)
+        dist = TruncNorm(mean, sigma, -interval, interval, nbins=self.nbins,
+                         bin_type=self.bin_type)
+        dist.quad_order = self.quad_order
+        return dist
+
+    def _set_group_dists(self, groups, interval):
+        for group in groups:
+            if group is None:
+                self.group_dists.append(None)
+                continue
+            group_nb = self._norm_based_dist(group, interval)
+            group_nl = self._norm_less_dist(
+                group['nl']['mean'], group['nl']['sigma'], interval)
+            self.group_dists.append((group_nl, group_nb))
+
+    def _blend_group_dists(self, previous_groups, ema):
+        for index, (dists, previous) in enumerate(
+                zip(self.group_dists, previous_groups)):
+            if dists is None or previous is None:
+                continue
+            group_nl, group_nb = dists
+            previous_nl, previous_nb = previous
+            group_nb.blend(previous_nb, ema)
+            second = (ema * (group_nl.sigma ** 2 + group_nl.mean ** 2)
+                      + (1 - ema) * (previous_nl.sigma ** 2
+                                     + previous_nl.mean ** 2))
+            mean = ema * group_nl.mean + (1 - ema) * previous_nl.mean
+            group_nl = self._norm_less_dist(
+                mean, (second - mean ** 2) ** 0.5, group_nl.end)
+            self.group_dists[index] = (group_nl, group_nb)
+
+    def _update_group_levels(self, grad_dist=None, quantile_dist=None):
+        """Solve the levels of all layer groups in a single batched pass of
+        the joint level optimizer, only used by the alqt methods.
+
+        Parameters:
+            grad_dist: distribution of the whole model solved in the same
+                batch, its levels are returned
+            quantile_dist: distribution of the quantile initialization of
+                grad_dist
+        """
+        bits = self.bits
+        norm_based = self.method.endswith('_nb')
+        solved = [i for i, dists in enumerate(self.group_dists)
+                  if dists is not None]
+        problems = [(group_nb if norm_based else group_nl, group_nb)
+                    for group_nl, group_nb in (
+                        self.group_dists[i] for i in solved)]
+        if grad_dist is not None:
+            problems.append((grad_dist, quantile_dist))
+        initial_levels = []
+        grad_dists = []
+        for dist, quantile_dist in problems:
+            initial_levels += [get_quantile_levels(bits, quantile_dist),
+                               get_uniform_levels(bits),
+                               get_exp_levels(bits, 0.5)]
+            grad_dists += [dist] * 3
+        candidate_levels, candidate_losses = alq_adam(
+            initial_levels, grad_dists, self.adam_epochs, self.adam_lr,
+            self.symmetric, self.levels.device)
+        # pick the best of the three initializations of every problem
+        best_levels = [candidate_levels[
+            3 * j + candidate_losses[3 * j:3 * j + 3].argmin()]
+            for j in range(len(problems))]
+
+        self.group_levels = [None] * len(self.group_dists)
+        self.group_qdq = [None] * len(self.group_dists)
+        for j, i in enumerate(solved):
+            self.group_levels[i] = torch.as_tensor(
+                best_levels[j], dtype=torch.float32).cuda()
+            self.group_qdq[i] = QDQ(self.group_levels[i])
+        if grad_dist is not None:
+            return best_levels[-1]
+
+    def _best_levels(self, candidate_levels, grad_dist):
+        """Pick the candidate levels with the minimum variance"""
+        candidate_levels = np.asarray(candidate_levels)
+        candidate_losses = grad_dist.estimate_variance_batch(candidate_levels)
+        return candidate_levels[np.argmin(candidate_losses)]
 
     def update_levels(self):
         """Main function to update the levels
         """
+        previous_levels = self.levels
+        with self.timer.stage('solver'):
+            self._solve_levels()
+        with self.timer.stage('upload'):
+            self.levels = torch.as_tensor(
+                self.levels, dtype=torch.float32).cuda()
+            self.qdq = QDQ(self.levels)
+        if len(self.levels) == len(previous_levels):
+            # largest change of a level since the last snapshot
+            self.level_jitter = (self.levels - previous_levels).abs().max()
+
+    def _solve_levels(self):
+        """Set self.levels using the quantization method
+        """
 
         bits = self.bits
         grad_dist_nl = self.grad_dist_nl
         grad_dist_nb = self.grad_dist_nb
+
+        cache_key = None
+        if self.levels_cache is not None:
+            cache_key = self.levels_cache.signature(
+                self.method, bits, grad_dist_nl, grad_dist_nb)
+            cached = self.levels_cache.get(cache_key)
+            if cached is not None:
+                self.levels, self.multiplier = cached
+                if self.method == 'amq' or self.method == 'amq_nb':
+                    self.previous_best = self.multiplier
+                if self.group_dists is not None:
+                    self._update_group_levels()
+                return
+
         half_point = int(len(self.levels) / 2)
         quantile_levels = get_quantile_levels(bits, grad_dist_nb)
         uniform_levels = get_uniform_levels(
@@ -379,114 +924,120 @@ class QuantizeMultiBucket(object):
             epochs = self.epochs
 
             # Try various initializations and pick the best one
-            levels_qua, _, losses_qua = alq(
+            levels_qua, _, _ = alq(
                 quantile_levels, grad_dist_nl, epochs, inv, sym)
-            levels_uniform, _, losses_uni = alq(
+            levels_uniform, _, _ = alq(
                 uniform_levels, grad_dist_nl, epochs, inv, sym)
-            levels_exp, _, losses_exp = alq(
+            levels_exp, _, _ = alq(
                 exp_levels, grad_dist_nl, epochs, inv, sym)
-            candidate_levels = np.asarray(
-                [levels_qua, levels_uniform, levels_exp])
-
-            candidate_losses = np.asarray(
-                [losses_qua[-1], losses_uni[-1], losses_exp[-1]])
 
             # Select the minimum loss
-            self.levels = candidate_levels[np.argsort(candidate_losses)][0]
+            self.levels = self._best_levels(
+                [levels_qua, levels_uniform, levels_exp], grad_dist_nl)
 
         elif self.method == 'alq_nb':
             epochs = self.epochs
             inv = self.inv
             sym = self.symmetric
             quantile_levels = get_quantile_levels(bits, grad_dist_nb)
-            levels_qua, _, losses_qua = alq(
+            levels_qua, _, _ = alq(
                 quantile_levels, grad_dist_nb, epochs, inv, sym)
-            levels_uniform, _, losses_uni = alq(
+            levels_uniform, _, _ = alq(
                 uniform_levels, grad_dist_nb, epochs, inv, sym)
-            levels_exp, _, losses_exp = alq(
+            levels_exp, _, _ = alq(
                 exp_levels, grad_dist_nb, epochs, inv, sym)
-            candidate_levels = np.asarray(
-                [levels_qua, levels_uniform, levels_exp])
-            candidate_losses = np.asarray(
-                [losses_qua[-1], losses_uni[-1], losses_exp[-1]])
-            self.levels = candidate_levels[np.argsort(candidate_losses)][0]
+            self.levels = self._best_levels(
+                [levels_qua, levels_uniform, levels_exp], grad_dist_nb)
 
         elif self.method == 'alqg_nb':
             epochs = self.epochs
             quantile_levels = get_quantile_levels(bits, grad_dist_nb)
-            levels_qua, _, losses_qua = alq_pgd(
+            levels_qua, _, _ = alq_pgd(
                 quantile_levels, grad_dist_nb, epochs)
-            levels_uniform, _, losses_uni = alq_pgd(
+            levels_uniform, _, _ = alq_pgd(
                 uniform_levels, grad_dist_nb, epochs)
-            levels_exp, _, losses_exp = alq_pgd(
+            levels_exp, _, _ = alq_pgd(
                 exp_levels, grad_dist_nb, epochs)
-            candidate_levels = np.asarray(
-                [levels_qua, levels_uniform, levels_exp])
-            candidate_losses = np.asarray(
-                [losses_qua[-1], losses_uni[-1], losses_exp[-1]])
-            self.levels = candidate_levels[np.argsort(candidate_losses)][0]
+            self.levels = self._best_levels(
+                [levels_qua, levels_uniform, levels_exp], grad_dist_nb)
 
         elif self.method == 'alqg':
             epochs = self.epochs
             quantile_levels = get_quantile_levels(bits, grad_dist_nb)
-            levels_qua, _, losses_qua = alq_pgd(
+            levels_qua, _, _ = alq_pgd(
                 quantile_levels, grad_dist_nl, epochs)
-            levels_uniform, _, losses_uni = alq_pgd(
+            levels_uniform, _, _ = alq_pgd(
                 uniform_levels, grad_dist_nl, epochs)
-            levels_exp, _, losses_exp = alq_pgd(
+            levels_exp, _, _ = alq_pgd(
                 exp_levels, grad_dist_nl, epochs)
-            candidate_levels = np.asarray(
-                [levels_qua, levels_uniform, levels_exp])
-            candidate_losses = np.asarray(
-                [losses_qua[-1], losses_uni[-1], losses_exp[-1]])
-            self.levels = candidate_levels[np.argsort(candidate_losses)][0]
-
-
-        elif self.method == 'amq':
-            initial_points = []
+            self.levels = self._best_levels(
+                [levels_qua, levels_uniform, levels_exp], grad_dist_nl)
+
+        elif self.method == 'alqt' or self.method == 'alqt_nb':
+            grad_dist = grad_dist_nl if self.method == 'alqt' else grad_dist_nb
+            if self.group_dists is not None:
+                # the whole model is solved in the same batch as the groups
+                self.levels = self._update_group_levels(
+                    grad_dist, grad_dist_nb)
+            else:
+                quantile_levels = get_quantile_levels(bits, grad_dist_nb)
+                # All initializations are optimized in a single batch
+                candidate_levels, candidate_losses = alq_adam(
+                    [quantile_levels, uniform_levels, exp_levels],
+                    [grad_dist] * 3, self.adam_epochs, self.adam_lr,
+                    self.symmetric, self.levels.device)
+                self.levels = candidate_levels[candidate_losses.argmin()]
+
+        elif self.method == 'alqdp':
+            self.levels = alq_dp(
+                grad_dist_nl, bits, self.dp_bins, self.symmetric)
+
+        elif self.method == 'alqdp_nb':
+            self.levels = alq_dp(
+                grad_dist_nb, bits, self.dp_bins, self.symmetric)
+
+        elif self.method == 'amq' or self.method == 'amq_nb':
+            if self.method == 'amq':
+                grad_dist = grad_dist_nl
+                amq_f = amq_norm_less
+                gradient_f = amq_norm_less_gradient
+            else:
+                grad_dist = grad_dist_nb
+                amq_f = amq_norm_based
+                gradient_f = amq_norm_based_gradient
 
-            if self.previous_best is None:
-                initial_points = [0.1, 0.2, 0.3, 0.4, 0.5, 0.6, 0.8, 0.9]
+            if self.amq_solver == 'secant':
+                optimal_points, nevals = amq_secant(
+                    lambda p: gradient_f(p, grad_dist, bits))
             else:
-                initial_points = [0.1, 0.2, 0.3, 0.4,
-                                  self.previous_best, 0.5,  0.8, 0.9]
-            optimal_points = []
-            for point in initial_points:
-                optimal_p, _ = amq_norm_less(
-                    point, grad_dist_nl, bits, self.amq_lr, self.amq_epochs)
-                optimal_points.append(optimal_p)
-            optimal_points_costs = [
-                grad_dist_nl.estimate_variance(get_exp_levels(bits, p)[
-                    half_point:]) for p in optimal_points]
+                if self.previous_best is None:
+                    initial_points = [0.1, 0.2, 0.3, 0.4, 0.5, 0.8, 0.9]
+                    if self.method == 'amq':
+                        initial_points.insert(5, 0.6)
+                else:
+                    initial_points = [0.1, 0.2, 0.3, 0.4,
+                                      self.previous_best, 0.5, 0.8, 0.9]
+                optimal_points = []
+                for point in initial_points:
+                    optimal_p, _ = amq_f(
+                        point, grad_dist, bits, self.amq_lr, self.amq_epochs)
+                    optimal_points.append(optimal_p)
+                nevals = len(initial_points) * self.amq_epochs
+            self.amq_evals = nevals
+            logging.info('AMQ multiplier search: %d gradient evaluations',
+                         nevals)
+
+            optimal_points_costs = grad_dist.estimate_variance_batch(
+                [get_exp_levels(bits, p)[half_point:]
+                 for p in optimal_points])
             index = np.argmin(optimal_points_costs)
             self.multiplier = optimal_points[index]
             self.previous_best = self.multiplier
             self.levels = get_exp_levels(bits, self.multiplier)
 
-        elif self.method == 'amq_nb':
-            initial_points = []
+        if cache_key is not None:
+            self.levels_cache.put(cache_key, self.levels, self.multiplier)
 
-            if self.previous_best is None:
-                initial_points = [0.1, 0.2, 0.3, 0.4, 0.5, 0.8, 0.9]
-            else:
-                initial_points = [0.1, 0.2, 0.3, 0.4,
-                                  self.previous_best, 0.5, 0.8, 0.9]
-            optimal_points = []
-            for point in initial_points:
-                optimal_p, _ = amq_norm_based(
-                    point, grad_dist_nb, bits, self.amq_lr, self.amq_epochs)
-                optimal_points.append(optimal_p)
-            optimal_points_costs = [
-                grad_dist_nb.estimate_variance(get_exp_levels(bits, p)[
-                    half_point:]) for p in optimal_points]
-            index = np.argmin(optimal_points_costs)
-            self.multiplier = optimal_points[index]
-            self.previous_best = self.multiplier
-            self.levels = get_exp_levels(self.bits, self.multiplier)
-
-        self.levels = torch.as_tensor(self.levels, dtype=torch.float32).cuda()
-        self.qdq = QDQ(self.levels)
-    
     def gradient_clipping(self, x_normalized, c=2.5):
         # c is the clipping hyperparamter
         # we use c equal to 2.5 as mentioned in the TernGrad 
@@ -496,13 +1047,19 @@ class QuantizeMultiBucket(object):
         x_normalized[indexes] = torch.sign(x_normalized[indexes]) * c * sigma
 
 
-    def quantize(self, x, ig_sm_bkts):
+    def quantize(self, x, ig_sm_bkts, layer=None):
         """The main quantization function. If ig_sm_bkts is enabled
         the last bucket that is smaller than the bucket size is
-        ignored.
+        ignored. If layer is given and per-group levels are available
+        the levels of the group of that layer are used.
         """
         if self.method == 'none':
             return x
+        qdq = self.qdq
+        if layer is not None and self.group_qdq is not None:
+            group_qdq = self.group_qdq[self.layer_groups[layer]]
+            if group_qdq is not None:
+                qdq = group_qdq
         assert isinstance(x, torch.cuda.FloatTensor)
         bucket_size = self.bucket_size
 
@@ -521,7 +1078,7 @@ class QuantizeMultiBucket(object):
             if xv.shape[0] > 1:
                 q = torch.zeros_like(xv)
                 r = torch.randint_like(xv, 1000001).long()
-                self.qdq.qdqGPU(xv[:-1], norm[:-1], q[:-1], r[:-1])
+                qdq.qdqGPU(xv[:-1], norm[:-1], q[:-1], r[:-1])
                 if num_tail > 0:
                     return torch.cat(
                         [q[:-1].view(-1),
@@ -535,7 +1092,7 @@ class QuantizeMultiBucket(object):
         else:
             q = torch.zeros_like(x)
             r = torch.randint_like(x, 1000001).long()
-            self.qdq.qdqGPU(x, norm, q, r)
+            qdq.qdqGPU(x, norm, q, r)
             return q
 
     def state_dict(self):
@@ -543,25 +1100,85 @@ class QuantizeMultiBucket(object):
             return {}
         return {
             'levels': self.levels,
-            'means': self.grad_dist_nb.means,
-            'sigmas': self.grad_dist_nb.sigmas,
-            'norms': self.grad_dist_nb.norms,
+            'interval': self.interval,
+            'means': self.norms['means'],
+            'sigmas': self.norms['sigmas'],
+            'norms': self.norms['norms'],
+            # binned pdf of the norm-based distribution, the cdf and the
+            # moment tables are its cumulative sums
+            'pdf_bin_sum': torch.as_tensor(
+                self.grad_dist_nb.pdf_bin_sum, dtype=torch.float32),
+            'bin_edges': (torch.as_tensor(self.grad_dist_nb.bin_edges)
+                          if self.bin_type != 'linear'
+                          or self.dist == 'sketch' else None),
+            'hist': (torch.as_tensor(self.grad_dist_nb.counts,
+                                     dtype=torch.float32)
+                     if self.dist == 'hist' else None),
             'sigma': self.grad_dist_nl.sigma,
             'mean': self.grad_dist_nl.mean,
-            'error': self.error
+            'error': self.error,
+            'multiplier': float(self.multiplier),
+            'previous_best': (float(self.previous_best)
+                              if self.previous_best is not None else None),
+            'levels_cache': (self.levels_cache.state_dict()
+                             if self.levels_cache is not None else None),
+            'layer_groups': self.layer_groups,
+            'group_levels': self.group_levels
         }
 
     def load_state_dict(self, state):
         if self.method == 'none':
             return
         self.levels = state['levels']
-        self.grad_dist_nb = CondNormalTruncHist(
-            state['means'], state['sigmas'], state['norms'], -1,
-            1, nbins=100000, bin_type='linear')
-
-        self.grad_dist_nl = TruncNorm(
-            state['mean'], state['sigma'], -1,
-            1, nbins=100000, bin_type='linear')
+        interval = state.get('interval', 1)
+        self.mean = state['mean']
+        self.variance = state['sigma'] ** 2
+        self.norms = {'means': state['means'], 'sigmas': state['sigmas'],
+                      'norms': state['norms']}
+        if self.dist_backend == 'torch':
+            self.grad_dist_nb = TorchCondNormalTruncHist(
+                state['means'], state['sigmas'], state['norms'], -interval,
+                interval, nbins=len(state['pdf_bin_sum']) + 1,
+                device=self.levels.device, pdf_bin_sum=state['pdf_bin_sum'])
+        elif state.get('hist') is not None:
+            self.grad_dist_nb = EmpiricalHist(
+                np.asarray(state['hist']), -interval, interval)
+        elif self.dist == 'sketch' and state.get('bin_edges') is not None:
+            # older checkpoints without the bins of the sketch fall back to
+            # the tables of the mixture below
+            self.grad_dist_nb = HistDistribution(
+                None, -interval, interval,
+                bin_edges=np.asarray(state['bin_edges']),
+                pdf_bin_sum=np.asarray(state['pdf_bin_sum']))
+        elif state.get('pdf_bin_sum') is not None:
+            pdf_bin_sum = np.asarray(state['pdf_bin_sum'])
+            bin_edges = state.get('bin_edges')
+            if bin_edges is not None:
+                bin_edges = np.asarray(bin_edges)
+            self.grad_dist_nb = CondNormalTruncHist(
+                state['means'], state['sigmas'], state['norms'], -interval,
+                interval, nbins=len(pdf_bin_sum) + 1, bin_type='linear',
+                pdf_bin_sum=pdf_bin_sum, bin_edges=bin_edges)
+        else:
+            self.grad_dist_nb = CondNormalTruncHist(
+                state['means'], state['sigmas'], state['norms'], -interval,
+                interval, nbins=self.nbins, bin_type=self.bin_type)
+        if self.dist_backend == 'numpy':
+            self.grad_dist_nb.quad_order = self.quad_order
+
+        self.grad_dist_nl = self._norm_less_dist(
+            state['mean'], state['sigma'], interval)
         self.qdq = QDQ(self.levels)
 
         self.error = state['error']
+        # multiplier of the amq levels and warm start of the gd solver
+        self.multiplier = state.get('multiplier', self.multiplier)
+        self.previous_best = state.get('previous_best')
+        if (self.levels_cache is not None
+                and state.get('levels_cache') is not None):
+            self.levels_cache.load_state_dict(state['levels_cache'])
+        if state.get('group_levels') is not None:
+            self.layer_groups = state['layer_groups']
+            self.group_levels = state['group_levels']
+            self.group_qdq = [QDQ(levels) if levels is not None else None
+                              for levels in self.group_levels]
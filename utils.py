@@ -14,6 +14,39 @@ class DictWrapper(object):
             return None
 
 
+class FlatBuffer(object):
+    """Parameters and gradients of a model in two contiguous tensors. The
+    parameters of the model and their gradients become views into them, so
+    the flattened gradient is free and the optimizer steps on `param`.
+
+    Parameters:
+        model (torch.nn.Module): model after it is moved to its device
+    """
+
+    def __init__(self, model):
+        self.params = list(model.parameters())
+        self.param = torch.nn.Parameter(
+            torch.cat([p.data.view(-1) for p in self.params]))
+        self.param.grad = torch.zeros_like(self.param)
+        self.grad = self.param.grad
+        self.grad_views = []
+        offset = 0
+        for p in self.params:
+            numel = p.numel()
+            p.data = self.param.data[offset:offset + numel].view_as(p)
+            self.grad_views.append(self.grad[offset:offset + numel].view_as(p))
+            offset += numel
+        self.zero_grad()
+        # the criteria call model.zero_grad(), which would otherwise set the
+        # gradients to None and drop the views
+        model.zero_grad = self.zero_grad
+
+    def zero_grad(self, set_to_none=False):
+        self.grad.zero_()
+        for p, grad in zip(self.params, self.grad_views):
+            p.grad = grad
+
+
 class SaveCheckpoint(object):
     def __init__(self):
         # remember best prec@1 and save checkpoint